@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 import aiohttp
@@ -7,7 +6,14 @@ from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, Mess
 from telegram.constants import ParseMode
 import asyncio
 from configs import ADMIN_IDS, FLASK_UPLOAD_URL
-from db import fetchall, fetchone, execute
+from db import fetchall, fetchone, execute, fetch_order_items
+from catalog_cache import invalidate_listings
+from reservations import cancel_order, confirm_order
+from sales import daily_sales, top_sellers
+from report_jobs import (
+    submit_report, list_jobs, STATUS_TITLES, build_products_report, build_orders_report,
+    build_orders_range_report, build_orders_incremental_report,
+)
 import pytz
 from datetime import datetime
 from functools import wraps
@@ -281,6 +287,7 @@ async def get_description(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # 4. Базаны жаңартып, артикулды сақтаймыз
     await execute("UPDATE products SET sku = ? WHERE id = ?", (sku, product_row['id']))
+    invalidate_listings(data['sub_category_id'])
 
     await update.message.reply_text(
         f"✅ Основной товар '{data['product_name']}' создан.\n"
@@ -397,6 +404,8 @@ async def get_variant_quantity(update: Update, context: ContextTypes.DEFAULT_TYP
     """Вариантты базаға сақтайды, size_id-ның None болу мүмкіндігін ескереді."""
     try:
         context.user_data['variant_quantity'] = int(update.message.text)
+        if context.user_data['variant_quantity'] < 0:
+            raise ValueError("отрицательный остаток")  # CHECK (quantity >= 0) в product_variants
         data = context.user_data
         
         # === МІНЕ, ЖАҢАРТЫЛҒАН ЖЕР ОСЫ ===
@@ -405,6 +414,7 @@ async def get_variant_quantity(update: Update, context: ContextTypes.DEFAULT_TYP
             "INSERT INTO product_variants (product_id, size_id, color_id, price, quantity) VALUES (?, ?, ?, ?, ?)",
             (data['product_id'], data.get('variant_size_id'), data['variant_color_id'], data['variant_price'], data['variant_quantity'])
         )
+        invalidate_listings()  # новый вариант может вывести товар в слайдер или изменить его цену
         # === ЖАҢАРТУДЫҢ СОҢЫ ===
         
         # Вариантты табу логикасы да сәл өзгереді
@@ -429,7 +439,7 @@ async def get_variant_quantity(update: Update, context: ContextTypes.DEFAULT_TYP
             return ADD_GET_VARIANT_MEDIA
             
     except ValueError:
-        await update.message.reply_text("Неверный формат. Введите количество как целое число.")
+        await update.message.reply_text("Неверный формат. Введите количество как целое неотрицательное число.")
         if context.user_data.get("mode") == "edit":
             return EDIT_ADD_VARIANT_QUANTITY
         return ADD_GET_VARIANT_QUANTITY
@@ -584,6 +594,7 @@ async def confirm_variant_delete(update: Update, context: ContextTypes.DEFAULT_T
     if query.data == "confirm_delete_variant":
         variant_id = context.user_data.get('variant_to_delete')
         await execute("DELETE FROM product_variants WHERE id = ?", (variant_id,))
+        invalidate_listings()
         await query.edit_message_text("✅ Вариант удален. Обновляю меню...")
     else: # cancel_delete
         await query.edit_message_text("Удаление отменено.")
@@ -598,6 +609,7 @@ async def confirm_full_product_delete(update: Update, context: ContextTypes.DEFA
         product_id = context.user_data.get('product_to_delete')
         await execute("DELETE FROM product_variants WHERE product_id = ?", (product_id,))
         await execute("DELETE FROM products WHERE id = ?", (product_id,))
+        invalidate_listings()
         await query.edit_message_text(f"✅ Товар с ID {product_id} и все его варианты были полностью удалены.")
         
         context.user_data.clear()
@@ -657,8 +669,12 @@ async def get_new_variant_value(update: Update, context: ContextTypes.DEFAULT_TY
     except ValueError:
         await update.message.reply_text("Неверный формат. Введите число.")
         return EDIT_GET_NEW_VARIANT_VALUE
+    if new_value < 0:
+        await update.message.reply_text("Значение не может быть отрицательным. Введите число.")
+        return EDIT_GET_NEW_VARIANT_VALUE
 
     await execute(f"UPDATE product_variants SET {field} = ? WHERE id = ?", (new_value, variant_id))
+    invalidate_listings()
     await update.message.reply_text(f"✅ Поле '{field}' для варианта успешно обновлено.")
     
     await show_edit_menu(update, context)
@@ -669,54 +685,46 @@ async def get_new_variant_value(update: Update, context: ContextTypes.DEFAULT_TY
 async def get_sales_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
-    report_data = await fetchone("SELECT COUNT(id) AS c, SUM(total_price) AS s FROM orders WHERE status = 'confirmed' AND created_at >= date('now', '-7 days')")
-    all_carts_data = await fetchall("SELECT cart FROM orders WHERE status = 'confirmed' AND created_at >= date('now', '-7 days')")
-    product_popularity = {}
-    for row in all_carts_data:
-        cart = json.loads(row['cart'])
-        for item_details in cart.values():
-            product_popularity[item_details['name']] = product_popularity.get(item_details['name'], 0) + item_details['quantity']
+    # Всё считается по свёртке продаж по дням (sales.py), без чтения заказов
+    days = await daily_sales(7)
+    sellers = await top_sellers(7, limit=5)
+    orders_count = sum(day['orders'] for day in days)
+    total_revenue = sum(day['revenue'] for day in days)
+
     most_popular_product_text = "Нет проданных товаров"
-    if product_popularity:
-        most_popular_item = max(product_popularity, key=product_popularity.get)
-        most_popular_product_text = f"{most_popular_item} (продано {product_popularity[most_popular_item]} шт.)"
-    orders_count, total_revenue = (report_data['c'] or 0), (report_data['s'] or 0)
+    if sellers:
+        most_popular_product_text = f"{sellers[0]['name']} (продано {sellers[0]['sold']} шт.)"
     report_message = (
         f"📊 <b>Отчет за 7 дней:</b>\n\n"
         f"• <b>Заказов:</b> {orders_count}\n"
         f"• <b>Выручка:</b> {int(total_revenue)} ₸\n"
         f"• <b>Хит продаж:</b> {most_popular_product_text}"
     )
+    if len(sellers) > 1:
+        report_message += "\n\n<b>Топ продаж:</b>\n" + "\n".join(
+            f"{i}. {seller['name']} — {seller['sold']} шт., {int(seller['revenue'])} ₸"
+            for i, seller in enumerate(sellers, 1)
+        )
+    if days:
+        report_message += "\n\n<b>По дням:</b>\n" + "\n".join(
+            f"{datetime.strptime(day['day'], '%Y-%m-%d'):%d.%m} — {day['orders']} зак., {int(day['revenue'])} ₸"
+            for day in days
+        )
     msg = get_effective_message(update)
     if msg:
         await msg.reply_text(report_message, parse_mode=ParseMode.HTML)
     
 
-from bee import fetch_products_detailed, export_to_gsheet, download_products_xlsx, GOOGLE_SHEET_URL
 # --- Отчёт по товарам ---
+# Сам отчёт строится в фоне (report_jobs.py) и приходит в этот же чат, когда готов.
 async def send_products_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # 1. Получаем актуальные данные и обновляем Google Sheet
-    data = fetch_products_detailed()
-    export_to_gsheet(data)
-    # 2. Скачиваем .xlsx-файл
-    xlsx_file = download_products_xlsx()
-
-    # 3. Отправляем ссылку на Google Таблицу
     msg = get_effective_message(update)
+    job = submit_report(context.bot, update.effective_chat.id, "products", "Отчёт по товарам", build_products_report)
     if msg:
-        await msg.reply_text("Генерирую отчёт по товарам...")
-        await msg.reply_text(f"Ссылка на Google Таблицу:\n{GOOGLE_SHEET_URL}")
-    # 4. Отправляем .xlsx файл (если скачался)
-    if xlsx_file:
-        with open(xlsx_file, "rb") as f:
-            msg = get_effective_message(update)
-            if msg:
-                await msg.reply_text("Отправляю .xlsx-файл с отчётом по товарам...")
-            await msg.reply_document(document=f, filename="products_report.xlsx", caption="Отчёт по товарам (.xlsx)")
-    else:
-        msg = get_effective_message(update)
-        if msg:
-            await msg.reply_text("Не удалось скачать .xlsx-файл. Проверьте права доступа.")
+        if job is None:
+            await msg.reply_text("⏳ Отчёт по товарам уже готовится — пришлю, как только будет готов.")
+        else:
+            await msg.reply_text("Генерирую отчёт по товарам... Пришлю файл сюда, когда будет готов.")
 
 
 from bee import fetch_orders_report, make_orders_report_text
@@ -735,22 +743,33 @@ async def ask_orders_report_period(update, context):
         [InlineKeyboardButton("Последние 3 дня", callback_data="orders_report_3days")],
         [InlineKeyboardButton("Последние 7 дней", callback_data="orders_report_7days")],
         [InlineKeyboardButton("Последние 30 дней", callback_data="orders_report_30days")],
+        [InlineKeyboardButton("Новые с прошлой выгрузки", callback_data="orders_report_new")],
     ]
     msg = get_effective_message(update)
     if msg:
         
         await msg.reply_text(
-            "Выберите период для отчёта по заказам:",
+            "Выберите период для отчёта по заказам:\n"
+            "(любой период: /orders_report 01.10.2025 15.10.2025)",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
 
-from bee import prepare_orders_data_for_gsheet, export_orders_to_gsheet, download_xlsx
-
 async def handle_orders_report_period(update, context):
     query = update.callback_query
     await query.answer()
     
     period_key = query.data.split("_")[-1]
+    if period_key == "new":
+        job = submit_report(
+            context.bot, query.message.chat_id, "orders_new",
+            "Отчёт по заказам (с прошлой выгрузки)", build_orders_incremental_report
+        )
+        if job is None:
+            await query.edit_message_text("⏳ Этот отчёт уже готовится — пришлю, как только будет готов.")
+        else:
+            await query.edit_message_text("Генерирую отчёт по новым заказам... Пришлю файл сюда, когда будет готов.")
+        return
+
     period_map = {
         "today": "today",
         "3days": "3days",
@@ -762,35 +781,61 @@ async def handle_orders_report_period(update, context):
         await query.edit_message_text("Некорректный период.")
         return
 
-    await query.edit_message_text("Генерирую отчёт по заказам, подождите...")
-
-    # Генерация данных
-    data = prepare_orders_data_for_gsheet(period)
-    if len(data) == 1:
-        await query.message.reply_text("❗️Заказов за выбранный период не найдено.")
-        return
+    # Отчёт строится в фоне (report_jobs.py) и приходит в этот же чат, когда готов
+    job = submit_report(
+        context.bot, query.message.chat_id, f"orders_{period}",
+        f"Отчёт по заказам ({PERIODS[period]})", build_orders_report, period, PERIODS[period]
+    )
+    if job is None:
+        await query.edit_message_text("⏳ Этот отчёт уже готовится — пришлю, как только будет готов.")
+    else:
+        await query.edit_message_text("Генерирую отчёт по заказам... Пришлю файл сюда, когда будет готов.")
 
-    # Экспорт в Google Sheet
-    spreadsheet_id, sheet_url = export_orders_to_gsheet(data, f"заказы_{period}")
 
-    # Скачивание .xlsx
-    xlsx_file = download_xlsx(spreadsheet_id, filename=f"orders_report_{period}.xlsx")
+async def orders_report_range(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/orders_report ДД.ММ.ГГГГ [ДД.ММ.ГГГГ] — отчёт по заказам за дни с первой даты по вторую включительно."""
+    if not is_admin(update.effective_user.id):
+        return
+    try:
+        dates = [datetime.strptime(arg, "%d.%m.%Y").date() for arg in context.args]
+    except ValueError:
+        dates = []
+    if len(dates) == 1:
+        dates.append(datetime.now().date())
+    if len(dates) != 2 or dates[0] > dates[1]:
+        await update.message.reply_text(
+            "Укажите период: /orders_report 01.10.2025 15.10.2025\n"
+            "(без второй даты — по сегодняшний день)"
+        )
+        return
 
-    # Отправка ссылки и файла
-    await query.message.reply_text(f"🔗 Ссылка на Google Таблицу:\n{sheet_url}")
-    
-    if xlsx_file:
-        with open(xlsx_file, "rb") as f:
-            await query.message.reply_document(
-                document=f,
-                filename=f"orders_report_{period}.xlsx",
-                caption=f"📄 Отчёт по заказам ({PERIODS[period]})"
-            )
+    date_from, date_to = dates
+    job = submit_report(
+        context.bot, update.effective_chat.id, f"orders_{date_from:%Y%m%d}_{date_to:%Y%m%d}",
+        f"Отчёт по заказам ({date_from:%d.%m.%Y} — {date_to:%d.%m.%Y})",
+        build_orders_range_report, date_from, date_to
+    )
+    if job is None:
+        await update.message.reply_text("⏳ Этот отчёт уже готовится — пришлю, как только будет готов.")
     else:
-        await query.message.reply_text("⚠️ Не удалось скачать .xlsx-файл.")
-
+        await update.message.reply_text("Генерирую отчёт по заказам... Пришлю файл сюда, когда будет готов.")
 
 
+async def show_report_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/reports — состояние фоновых отчётов."""
+    if not is_admin(update.effective_user.id):
+        return
+    jobs = list_jobs()
+    if not jobs:
+        await update.message.reply_text("Отчётов пока не было.")
+        return
+    lines = ["📊 Отчёты:"]
+    for job in jobs:
+        line = f"#{job.id} {job.title} — {STATUS_TITLES[job.status]} ({job.created_at:%H:%M:%S})"
+        if job.error:
+            line += f": {job.error}"
+        lines.append(line)
+    await update.message.reply_text("\n".join(lines))
 
 
 async def report_combined(update, context):
@@ -841,11 +886,8 @@ async def update_order_status_admin(update: Update, context: ContextTypes.DEFAUL
 
     user_link = f'<a href="https://t.me/{username}">@{username}</a>' if username else "нет username"
 
-    try:
-        cart = json.loads(order['cart'])
-        cart_text = "\n".join([f"• {item['name']} (x{item['quantity']})\nБренд: {item.get('brand', 'Не указано')}" for item in cart.values()])
-    except Exception:
-        cart_text = "Ошибка при разборе состава заказа"
+    items = await fetch_order_items(order_id)
+    cart_text = "\n".join([f"• {item['name']} (x{item['quantity']})\nБренд: {item['brand'] or 'Не указано'}" for item in items])
 
     user_check = (
         f"📦 <b>Информация о заказе №{order_id}</b>\n\n"
@@ -952,19 +994,28 @@ async def admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- ЛОГИКА ДЛЯ "ПОДТВЕРДИТЬ" ---
     if action == "admin_confirm":
         try:
-            cart = json.loads(order['cart'])
-
-            # 💥 Ключевая проверка: избежать двойного списания
-            if str(order["deducted_from_stock"]) != "1":
-                for variant_id_str, item in cart.items():
-                    await execute(
-                        "UPDATE product_variants SET quantity = quantity - ? WHERE id = ?",
-                        (item['quantity'], int(variant_id_str))
-                    )
-                await execute("UPDATE orders SET deducted_from_stock = 1 WHERE id = ?", (order_id,))
+            items = await fetch_order_items(order_id)
+
+            # Резерв -> списание -> статус одной транзакцией; если хоть одной позиции
+            # не хватает, не меняется ничего
+            short = await confirm_order(order_id, items)
+            if short is None:
+                await query.edit_message_text(f"⚠️ Заказ №{order_id} уже обработан или отменён — подтвердить его нельзя.")
+                return
+            if short:
+                logging.warning(f"⚠️ Заказ №{order_id} не подтверждён: не хватает остатка по позициям {[item['name'] for item in short]}")
+                short_text = "\n".join(f"• {item['name']} x{item['quantity']}" for item in short)
+                retry_buttons = [
+                    [InlineKeyboardButton("✅ Подтвердить ещё раз", callback_data=f"admin_confirm_{order_id}")],
+                    [InlineKeyboardButton("❌ Отклонить", callback_data=f"admin_reject_{order_id}")],
+                ]
+                await query.edit_message_text(
+                    f"⚠️ Заказ №{order_id} не подтверждён — на складе не хватает (или вариант удалён):\n{short_text}\n\n"
+                    "Пополните остаток и подтвердите заказ ещё раз или отклоните его.",
+                    reply_markup=InlineKeyboardMarkup(retry_buttons)
+                )
+                return
 
-            await execute("UPDATE orders SET status = ? WHERE id = ?", ('confirmed', order_id))
-            
             kb = [[InlineKeyboardButton("История заказов 🗒" , callback_data="order_history")]]
             await context.bot.send_message(
                 chat_id=order["user_id"],
@@ -991,26 +1042,19 @@ async def admin_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- ЛОГИКА ДЛЯ "ОТКЛОНИТЬ" (любого типа) ---
     elif 'admin_reject' in action:
-        # --- Сначала возвращаем товары на склад, если они были списаны ---
-        if str(order["deducted_from_stock"]) == "1":
-            try:
-                cart = json.loads(order["cart"])
-                for variant_id_str, item in cart.items():
-                    await execute(
-                        "UPDATE product_variants SET quantity = quantity + ? WHERE id = ?",
-                        (item['quantity'], int(variant_id_str))
-                    )
-                await execute("UPDATE orders SET deducted_from_stock = 0 WHERE id = ?", (order_id,))
-            except Exception as e:
-                await query.edit_message_text(f"❌ Ошибка при возврате товаров: {e}")
-                return
-        
-        # --- Обновляем статус в БД ---
-        await execute("UPDATE orders SET status = ? WHERE id = ?", ("rejected", order_id))
+        # --- Возврат на склад (если товары были списаны) и смена статуса — одной транзакцией ---
+        items = await fetch_order_items(order_id)
+        try:
+            rejected = await cancel_order(order_id, items, "rejected")
+        except Exception as e:
+            await query.edit_message_text(f"❌ Ошибка при возврате товаров: {e}")
+            return
+        if not rejected:
+            await query.edit_message_text(f"⚠️ Заказ №{order_id} уже завершён или отменён — отклонить его нельзя.")
+            return
 
         # --- Формируем и отправляем уведомления ---
-        cart = json.loads(order['cart'])
-        cart_text = "\n".join([f"• {item['name']} x{item['quantity']}" for item in cart.values()])
+        cart_text = "\n".join([f"• {item['name']} x{item['quantity']}" for item in items])
         
         username = None
         try:
@@ -1064,6 +1108,12 @@ def is_finished(status):
     return status in ("delivered", "cancelled_by_client", "rejected")
 
 # --- История заказов клиента ---
+# Состав заказа (order_items) подгружается при показе страницы, здесь он не нужен
+ORDER_HISTORY_SQL = """
+    SELECT id, user_name, user_phone, user_address, total_price, status, created_at
+    FROM orders WHERE user_id = ? ORDER BY id DESC
+"""
+
 async def order_history_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -1098,7 +1148,7 @@ async def order_filter_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     context.user_data["order_filter"] = filter_type
 
     user_id = update.effective_user.id
-    orders = await fetchall("SELECT * FROM orders WHERE user_id = ? ORDER BY id DESC", (user_id,))
+    orders = await fetchall(ORDER_HISTORY_SQL, (user_id,))
 
     if filter_type == "active":
         orders = [o for o in orders if is_active(o["status"])]
@@ -1155,10 +1205,10 @@ async def show_orders_text(update, context, orders, filter_type, page):
     raw_status = order["status"]
     status = f"{status_names.get(raw_status, raw_status)}"
     total = f"{order['total_price']}"
-    cart = json.loads(order["cart"])
+    items = await fetch_order_items(order['id'])
     
     cart_text = "\n".join([
-        f"• {item['name']} (x{item['quantity']})\nБренд: {item.get('brand', 'Не указано')}" for item in cart.values()
+        f"• {item['name']} (x{item['quantity']})\nБренд: {item['brand'] or 'Не указано'}" for item in items
     ])
     msg = (
         f"🧾 <b>Чек №{order_id}</b>\n\n"
@@ -1231,22 +1281,17 @@ async def confirm_cancel_from_history(update: Update, context: ContextTypes.DEFA
         await query.edit_message_text("⚠️ Этот заказ уже завершён или отменён. Отмена невозможна.")
         return
 
-    # 🔄 Возвращаем товар на склад, если был списан
-    if str(order["deducted_from_stock"]) == "1":
-        try:
-            cart = json.loads(order["cart"])
-            for variant_id_str, item in cart.items():
-                await execute(
-                    "UPDATE product_variants SET quantity = quantity + ? WHERE id = ?",
-                    (item['quantity'], int(variant_id_str))
-                )
-            await execute("UPDATE orders SET deducted_from_stock = 0 WHERE id = ?", (order_id,))
-        except Exception as e:
-            await query.edit_message_text(f"❌ Ошибка при возврате товара на склад: {e}")
-            return
+    # 🔄 Возвращаем товар на склад, если был списан, и 🛑 меняем статус — одной транзакцией
+    items = await fetch_order_items(order_id)
+    try:
+        cancelled = await cancel_order(order_id, items, "cancelled_by_client")
+    except Exception as e:
+        await query.edit_message_text(f"❌ Ошибка при возврате товара на склад: {e}")
+        return
+    if not cancelled:
+        await query.edit_message_text("⚠️ Этот заказ уже завершён или отменён. Отмена невозможна.")
+        return
 
-    # 🛑 Меняем статус заказа
-    await execute("UPDATE orders SET status = ? WHERE id = ?", ("cancelled_by_client", order_id))
     await query.edit_message_text("❌ Заказ был отменён.")
 
     # 👤 Получаем username
@@ -1260,9 +1305,8 @@ async def confirm_cancel_from_history(update: Update, context: ContextTypes.DEFA
     user_link = f'<a href="https://t.me/{username}">@{username}</a>' if username else "нет username"
 
     # 🧾 Формируем состав заказа
-    cart = json.loads(order['cart'])
     cart_text = "\n".join([
-        f"• {item['name']} x{item['quantity']}" for item in cart.values()
+        f"• {item['name']} x{item['quantity']}" for item in items
     ])
 
     # 📦 Информация для админа
@@ -1345,6 +1389,7 @@ async def handle_cat_manage(update, context):
             cat_id = int(parts[3])
             await execute("DELETE FROM categories WHERE id = ?", (cat_id,))
             await execute("DELETE FROM sub_categories WHERE category_id = ?", (cat_id,))
+            invalidate_listings()
             await query.edit_message_text(f"Категория {cat_id} и все её разделы удалены.")
         else:
             await query.edit_message_text("Ошибка: не удалось определить категорию для удаления.")
@@ -1427,6 +1472,7 @@ async def handle_subcat_manage(update, context):
         if parts[-1].isdigit():
             subcat_id = int(parts[-1])
             await execute("DELETE FROM sub_categories WHERE id = ?", (subcat_id,))
+            invalidate_listings(subcat_id)
             await query.edit_message_text(f"Раздел {subcat_id} удален.")
         else:
             await query.edit_message_text("Ошибка: не удалось определить раздел для удаления.")
@@ -1538,6 +1584,7 @@ async def handle_brand_manage(update, context):
         if parts[-1].isdigit():
             brand_id = int(parts[-1])
             await execute("DELETE FROM brands WHERE id = ?", (brand_id,))
+            invalidate_listings()
             await query.edit_message_text(f"Бренд {brand_id} удален.")
         else:
             await query.edit_message_text("Ошибка: не удалось определить бренд для удаления.")
@@ -1589,6 +1636,7 @@ async def finish_rename_brand(update, context):
             await msg.reply_text("Ошибка: не удалось переименовать бренд.")
         return ConversationHandler.END
     await execute("UPDATE brands SET name = ? WHERE id = ?", (new_name, brand_id))
+    invalidate_listings()  # имя бренда показывается в карточке слайдера
     msg = get_effective_message(update)
     if msg:
         await msg.reply_text(f"Бренд переименован в {new_name}.")
@@ -1673,7 +1721,7 @@ async def admin_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
             return ConversationHandler.END  # <----- обязательно!
 
         elif data == "admin_report":
-            await query.edit_message_text(f"Формирую отчёт... \nПожалуйста подождите 10-20 секунд.")
+            await query.edit_message_text("Формирую отчёт... \nСводка придёт сразу, таблица и файл — когда будут готовы.")
             await report_combined(update, context)
             return ConversationHandler.END  # <----- обязательно!
 
@@ -2109,5 +2157,7 @@ cat_rename_text_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, catego
 # === Админские действия ===
 report_handler = CallbackQueryHandler(report_combined, pattern=r"^admin_report$")
 orders_report_handler = CallbackQueryHandler(ask_orders_report_period, pattern=r"^admin_orders_report$")
-orders_report_period_handler = CallbackQueryHandler(handle_orders_report_period, pattern=r"^orders_report_(today|3days|7days|30days)$")
+orders_report_period_handler = CallbackQueryHandler(handle_orders_report_period, pattern=r"^orders_report_(today|3days|7days|30days|new)$")
+orders_report_range_handler = CommandHandler("orders_report", orders_report_range)
+report_jobs_handler = CommandHandler("reports", show_report_jobs)
 admin_decision_handler = CallbackQueryHandler(admin_decision, pattern=r"^(admin_confirm|admin_reject|admin_reject_after_confirm)_\d+$")
\ No newline at end of file
@@ -1,10 +1,9 @@
 import sqlite3
 import pathlib
 import gspread
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from collections import defaultdict
 from google.oauth2.service_account import Credentials
-import json
 import requests
 from pathlib import Path
 from configs import DB_FILE
@@ -184,32 +183,118 @@ def download_products_xlsx():
 
 # --- ОТЧЕТЫ ПО ЗАКАЗАМ ---
 
-def fetch_orders_report(period: str):
+def orders_period_start(period: str):
     # period: "today", "3days", "7days", "30days"
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
     now = datetime.now()
     if period == "today":
-        since = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        return now.replace(hour=0, minute=0, second=0, microsecond=0)
     elif period == "3days":
-        since = now - timedelta(days=3)
+        return now - timedelta(days=3)
     elif period == "7days":
-        since = now - timedelta(days=7)
+        return now - timedelta(days=7)
     elif period == "30days":
-        since = now - timedelta(days=30)
+        return now - timedelta(days=30)
+    return None
+
+
+def _db_time(value):
+    # orders.created_at хранится в формате CURRENT_TIMESTAMP ('YYYY-MM-DD HH:MM:SS'),
+    # поэтому границы сравниваем со столбцом как строки — без datetime(), по индексу
+    return value.strftime("%Y-%m-%d %H:%M:%S") if isinstance(value, date) else value
+
+
+# Состав заказа собираем в SQL из order_items (без json.loads по каждому заказу).
+# {where}, {group_order} — условие отбора и порядок; группировка идёт в порядке индекса,
+# поэтому строки читаются потоком, без сортировки всего периода.
+ORDERS_REPORT_SQL = """
+    SELECT o.id, o.user_name, o.user_address, o.user_phone, o.total_price, o.status, o.created_at,
+           COALESCE(SUM(oi.quantity), 0) AS total_qty,
+           COALESCE(GROUP_CONCAT(oi.name || ' x' || oi.quantity, '; '), '') AS items_str,
+           COALESCE(GROUP_CONCAT(oi.name || ' x' || oi.quantity || ' (Бренд: ' || COALESCE(oi.brand, 'Не указано') || ')', '; '), '') AS items_brand_str
+    FROM orders o
+    LEFT JOIN order_items oi ON oi.order_id = o.id
+    WHERE {where}
+    {group_order}
+"""
+
+
+def _orders_report_query(date_from=None, date_to=None, after_id=None, up_to_id=None):
+    """SQL и параметры отчёта по заказам.
+
+    date_from/date_to — диапазон created_at [от, до), по индексу idx_orders_created;
+    заказы от новых к старым.
+    after_id/up_to_id — заказы с id в (after_id, up_to_id] (выгрузка "с прошлого раза"),
+    по первичному ключу; заказы по порядку поступления.
+    """
+    conditions, params = [], []
+    if after_id is not None or up_to_id is not None:
+        if after_id is not None:
+            conditions.append("o.id > ?")
+            params.append(after_id)
+        if up_to_id is not None:
+            conditions.append("o.id <= ?")
+            params.append(up_to_id)
+        group_order = "GROUP BY o.id ORDER BY o.id"
     else:
-        conn.close()
+        if date_from is not None:
+            conditions.append("o.created_at >= ?")
+            params.append(_db_time(date_from))
+        if date_to is not None:
+            conditions.append("o.created_at < ?")
+            params.append(_db_time(date_to))
+        group_order = "GROUP BY o.created_at, o.id ORDER BY o.created_at DESC, o.id DESC"
+    where = " AND ".join(conditions) or "1"
+    return ORDERS_REPORT_SQL.format(where=where, group_order=group_order), params
+
+
+def fetch_orders_report(period: str):
+    since = orders_period_start(period)
+    if since is None:
         return None
+    return list(iter_orders_range(date_from=since))
 
-    c.execute("""
-        SELECT id, user_name, user_address, user_phone, cart, total_price, status, created_at
-        FROM orders
-        WHERE datetime(created_at) >= ?
-        ORDER BY created_at DESC
-    """, (since.strftime("%Y-%m-%d %H:%M:%S"),))
-    orders = c.fetchall()
-    conn.close()
-    return orders
+
+def iter_orders_range(date_from=None, date_to=None, after_id=None, up_to_id=None, chunk_size: int = 500):
+    """Заказы для отчёта (см. _orders_report_query) построчно: из БД читаем по chunk_size."""
+    sql, params = _orders_report_query(date_from, date_to, after_id, up_to_id)
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        c = conn.cursor()
+        c.execute(sql, params)
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+
+def iter_orders_report(period: str, chunk_size: int = 500):
+    """То же, что fetch_orders_report, но построчно: из БД читаем по chunk_size заказов."""
+    since = orders_period_start(period)
+    if since is None:
+        return
+    yield from iter_orders_range(date_from=since, chunk_size=chunk_size)
+
+
+def last_order_id():
+    """id последнего заказа в базе (0, если заказов нет)."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def get_report_mark(name: str):
+    """Отметка выгрузки name из report_state: id последнего выгруженного заказа (0, если выгрузок не было)."""
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        row = conn.execute("SELECT last_order_id FROM report_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+    finally:
+        conn.close()
 
 def make_orders_report_text(orders, period: str):
     if not orders:
@@ -219,13 +304,7 @@ def make_orders_report_text(orders, period: str):
     total_sum = 0
     total_count = 0
     for o in orders:
-        oid, uname, addr, phone, cart_json, total, status, created = o
-        try:
-            cart = json.loads(cart_json)
-        except Exception:
-            cart = {}
-        total_qty = sum(item.get("quantity", 0) for item in cart.values())
-        items_str = "; ".join(f'{item["name"]} x{item["quantity"]}' for item in cart.values())
+        oid, uname, addr, phone, total, status, created, total_qty, items_str, _ = o
         rus_status = STATUS_MAP.get(status, "Неизвестен")
         lines.append(
             f"— №{oid} | {uname} | {rus_status} | {round(total)}₸ | Товаров: {total_qty} | {created[:16]}\n    {items_str}"
@@ -239,13 +318,7 @@ def prepare_orders_report_data(orders, period: str):
     if not orders:
         return data + [["", "", "", "", "", "", "", "", f"Нет заказов за период: {period}"]]
     for o in orders:
-        oid, uname, addr, phone, cart_json, total, status, created = o
-        try:
-            cart = json.loads(cart_json)
-        except Exception:
-            cart = {}
-        total_qty = sum(item.get("quantity", 0) for item in cart.values())
-        items_str = "; ".join(f'{item["name"]} x{item["quantity"]}' for item in cart.values())
+        oid, uname, addr, phone, total, status, created, total_qty, items_str, _ = o
         rus_status = STATUS_MAP.get(status, "Неизвестен")
         data.append([
             oid, uname, addr, phone, rus_status,
@@ -253,24 +326,30 @@ def prepare_orders_report_data(orders, period: str):
         ])
     return data
 
-def prepare_orders_data_for_gsheet(period: str):
-    orders = fetch_orders_report(period)
-    data = [["ID", "Имя", "Телефон", "Адрес", "Статус", "Дата", "Товары", "Итог (₸)", "Кол-во товаров"]]
-    for o in orders:
-        oid, uname, addr, phone, cart_json, total, status, created = o
-        try:
-            cart = json.loads(cart_json)
-        except:
-            cart = {}
-        items_str = "; ".join(
-            f'{item["name"]} x{item["quantity"]} (Бренд: {item.get("brand", "Не указано")})'
-            for item in cart.values()
-        )
+ORDERS_SHEET_HEADER = ["ID", "Имя", "Телефон", "Адрес", "Статус", "Дата", "Товары", "Итог (₸)", "Кол-во товаров"]
 
-        total_qty = sum(item.get("quantity", 0) for item in cart.values())
-        rus_status = STATUS_MAP.get(status, "Неизвестен")
-        data.append([oid, uname, phone, addr, rus_status, created[:16], items_str, round(total), total_qty])
-    return data
+
+def _orders_sheet_row(o):
+    oid, uname, addr, phone, total, status, created, total_qty, _, items_str = o
+    rus_status = STATUS_MAP.get(status, "Неизвестен")
+    return [oid, uname, phone, addr, rus_status, created[:16], items_str, round(total), total_qty]
+
+
+def prepare_orders_data_for_gsheet(period: str = None, **order_range):
+    """Данные для Google Таблицы: по period или по диапазону (аргументы iter_orders_range)."""
+    orders = fetch_orders_report(period) if period else iter_orders_range(**order_range)
+    return [ORDERS_SHEET_HEADER] + [_orders_sheet_row(o) for o in orders]
+
+
+def iter_orders_sheet_rows(period: str = None, **order_range):
+    """Строки отчёта по заказам (сначала заголовок) — генератор для потоковой выгрузки в .xlsx.
+
+    Заказы — по period или по диапазону (аргументы iter_orders_range).
+    """
+    yield ORDERS_SHEET_HEADER
+    orders = iter_orders_report(period) if period else iter_orders_range(**order_range)
+    for o in orders:
+        yield _orders_sheet_row(o)
 
 
 
@@ -315,8 +394,17 @@ def export_orders_to_gsheet(data, sheet_title):
 
 import xlsxwriter
 
-def export_to_excel_xlsxwriter(data, filename="report.xlsx"):
-    workbook = xlsxwriter.Workbook(filename)
+def export_to_excel_xlsxwriter(data, filename="report.xlsx", constant_memory=False):
+    """Сохраняет строки data (первая — заголовок) в .xlsx.
+
+    data может быть генератором (см. iter_orders_sheet_rows): строки читаются один раз.
+
+    constant_memory=True — режим xlsxwriter, в котором каждая строка сразу сбрасывается
+    на диск и в памяти держится только текущая: для больших отчётов.
+    Поэтому всё делаем за один проход: высота строки задаётся до записи её ячеек,
+    ширина колонок копится по ходу и выставляется в конце.
+    """
+    workbook = xlsxwriter.Workbook(filename, {'constant_memory': constant_memory})
     worksheet = workbook.add_worksheet("Отчет")
 
     wrap_format = workbook.add_format({
@@ -324,26 +412,29 @@ def export_to_excel_xlsxwriter(data, filename="report.xlsx"):
         'valign': 'top'
     })
 
-    # Запись данных
-    for row_idx, row in enumerate(data):
-        for col_idx, value in enumerate(row):
-            worksheet.write(row_idx, col_idx, str(value), wrap_format)
-
-    # Автоширина по колонкам
-    for col_idx in range(len(data[0])):
-        max_width = max(len(str(row[col_idx])) for row in data if len(row) > col_idx)
-        worksheet.set_column(col_idx, col_idx, min(max_width * 1.1, 60))  # до 60 символов ширина
-
-    # Установка высоты строки
+    widths = []
     for row_idx, row in enumerate(data):
+        # Установка высоты строки
         max_lines = 1
         for cell in row:
             lines = str(cell).count('\n') + max(1, len(str(cell)) // 40)
             max_lines = max(max_lines, lines)
         worksheet.set_row(row_idx, max_lines * 15)
 
+        # Запись данных
+        for col_idx, value in enumerate(row):
+            worksheet.write(row_idx, col_idx, str(value), wrap_format)
+            if col_idx >= len(widths):
+                widths.append(0)
+            widths[col_idx] = max(widths[col_idx], len(str(value)))
+
+    # Автоширина по колонкам
+    for col_idx, max_width in enumerate(widths):
+        worksheet.set_column(col_idx, col_idx, min(max_width * 1.1, 60))  # до 60 символов ширина
+
     workbook.close()
     print(f"✅ Excel (XlsxWriter) файл сохранён: {filename}")
+    return filename
 
 
 
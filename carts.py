@@ -0,0 +1,182 @@
+import json
+import time
+from collections import OrderedDict
+
+from db import fetchall, transaction
+
+# Корзины покупателей в таблице carts (user_id, variant_id, qty, added_at) вместо
+# context.user_data['cart']. В корзине только id вариантов и количество; название,
+# цена и бренд подставляются из каталога при показе (cart_lines), поэтому корзина
+# всегда с актуальными ценами и не раздувает сохраняемые user_data.
+#
+# Кеш в памяти — write-through: каждое изменение сначала пишется в БД (атомарным
+# UPDATE ... RETURNING), затем тот же результат кладётся в кеш. Корзину, изменённую
+# другим процессом, кеш покажет не позже чем через CART_CACHE_TTL секунд.
+
+CART_CACHE_SIZE = 10000   # сколько корзин держим в памяти (вытесняется самая давняя)
+CART_CACHE_TTL = 300      # секунд; после этого корзина перечитывается из БД
+
+# Корзина покупателя в порядке добавления
+CART_SQL = "SELECT variant_id, qty FROM carts WHERE user_id = ? ORDER BY added_at, variant_id"
+# Варианты корзины для показа; id вариантов — JSON-список
+CART_LINES_SQL = """
+    SELECT pv.id, pv.price, pv.quantity - pv.reserved AS stock, p.name, s.name AS size, c.name AS color, b.name AS brand
+    FROM product_variants pv
+    JOIN products p ON pv.product_id = p.id
+    LEFT JOIN sizes s ON pv.size_id = s.id
+    LEFT JOIN colors c ON pv.color_id = c.id
+    LEFT JOIN brands b ON p.brand_id = b.id
+    WHERE pv.id IN (SELECT value FROM json_each(?))
+"""
+
+# user_id -> (момент устаревания, {variant_id: qty} в порядке добавления)
+_cache = OrderedDict()
+
+
+def _cache_get(user_id):
+    entry = _cache.get(user_id)
+    if entry is None:
+        return None
+    expires, items = entry
+    if expires < time.monotonic():
+        del _cache[user_id]
+        return None
+    _cache.move_to_end(user_id)
+    return items
+
+
+def _cache_put(user_id, items):
+    _cache[user_id] = (time.monotonic() + CART_CACHE_TTL, items)
+    _cache.move_to_end(user_id)
+    while len(_cache) > CART_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _cache_set_qty(user_id, variant_id, qty):
+    # Кладём в кеш результат записи, только если корзина уже в кеше
+    items = _cache_get(user_id)
+    if items is None:
+        return
+    if qty > 0:
+        items[variant_id] = qty
+    else:
+        items.pop(variant_id, None)
+
+
+async def get_cart(user_id):
+    """{variant_id: количество} в порядке добавления (копия, менять её бесполезно)."""
+    items = _cache_get(user_id)
+    if items is None:
+        rows = await fetchall(CART_SQL, (user_id,))
+        items = {row['variant_id']: row['qty'] for row in rows}
+        _cache_put(user_id, items)
+    return dict(items)
+
+
+async def add_item(user_id, variant_id, limit):
+    """+1 штука варианта, но не больше limit (остаток на складе).
+
+    Возвращает новое количество в корзине или None, если уже положено limit штук.
+    """
+    async with transaction() as tx:
+        row = await tx.fetchone("""
+            INSERT INTO carts (user_id, variant_id, qty) VALUES (?1, ?2, 1)
+            ON CONFLICT (user_id, variant_id) DO UPDATE SET qty = qty + 1 WHERE qty < ?3
+            RETURNING qty
+        """, (user_id, variant_id, limit))
+    if row is None:
+        return None
+    _cache_set_qty(user_id, variant_id, row['qty'])
+    return row['qty']
+
+
+async def change_quantity(user_id, variant_id, delta, limit=None):
+    """Меняет количество на delta; при нуле позиция удаляется.
+
+    Возвращает новое количество (0 — позиция удалена) или None, если позиции нет
+    в корзине или количество упёрлось бы в limit.
+    """
+    limit_sql, params = "", (user_id, variant_id, delta)
+    if limit is not None:
+        limit_sql, params = "AND qty + ?3 <= ?4", params + (limit,)
+    async with transaction() as tx:
+        row = await tx.fetchone(f"""
+            UPDATE carts SET qty = qty + ?3
+            WHERE user_id = ?1 AND variant_id = ?2 {limit_sql}
+            RETURNING qty
+        """, params)
+        if row is not None and row['qty'] <= 0:
+            await tx.execute("DELETE FROM carts WHERE user_id = ? AND variant_id = ?", (user_id, variant_id))
+    if row is None:
+        return None
+    qty = max(row['qty'], 0)
+    _cache_set_qty(user_id, variant_id, qty)
+    return qty
+
+
+async def clear_cart(user_id, tx=None):
+    """Очищает корзину. tx — транзакция, в которой это сделать (например, вместе с созданием заказа).
+
+    С tx кеш не трогается: до коммита корзина ещё не пуста, а при откате останется как была.
+    После коммита вызывающий код сам вызывает forget_cart(user_id).
+    """
+    if tx is not None:
+        await tx.execute("DELETE FROM carts WHERE user_id = ?", (user_id,))
+        return
+    async with transaction() as tx:
+        await tx.execute("DELETE FROM carts WHERE user_id = ?", (user_id,))
+    _cache_put(user_id, {})
+
+
+def forget_cart(user_id):
+    """Убирает корзину из кеша: следующий get_cart перечитает её из БД."""
+    _cache.pop(user_id, None)
+
+
+async def cart_lines(user_id):
+    """Корзина для показа и оформления: список dict с variant_id, quantity, name, price, brand, stock.
+
+    stock — свободный остаток варианта (без зарезервированного за заказами).
+    Позиции удалённых вариантов убираются из корзины.
+    """
+    items = await get_cart(user_id)
+    if not items:
+        return []
+    rows = await fetchall(CART_LINES_SQL, (json.dumps(list(items)),))
+    variants = {row['id']: row for row in rows}
+
+    lines = []
+    for variant_id, qty in items.items():
+        variant = variants.get(variant_id)
+        if variant is None:
+            await change_quantity(user_id, variant_id, -qty)
+            continue
+        details = ", ".join(part for part in (variant['size'], variant['color']) if part)
+        lines.append({
+            'variant_id': variant_id,
+            'quantity': qty,
+            'name': f"{variant['name']} ({details})" if details else variant['name'],
+            'price': variant['price'],
+            'brand': variant['brand'],
+            'stock': variant['stock'],
+        })
+    return lines
+
+
+async def adopt_legacy_cart(user_id, user_data):
+    """Переносит старую корзину из user_data['cart'] (до таблицы carts) в таблицу, один раз."""
+    legacy = user_data.pop('cart', None)
+    user_data.pop('checkout_cart', None)
+    if not isinstance(legacy, dict) or not legacy:
+        return
+    rows = [
+        (user_id, int(variant_id), int(item.get('quantity', 0)))
+        for variant_id, item in legacy.items()
+        if str(variant_id).isdigit() and isinstance(item, dict) and item.get('quantity', 0) > 0
+    ]
+    async with transaction() as tx:
+        await tx.executemany("""
+            INSERT INTO carts (user_id, variant_id, qty) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, variant_id) DO UPDATE SET qty = MAX(qty, excluded.qty)
+        """, rows)
+    forget_cart(user_id)
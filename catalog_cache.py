@@ -0,0 +1,107 @@
+import logging
+
+from db import fetchone
+from search import invalidate_search
+from stock_cache import invalidate_stock
+
+# Постраничная выборка для слайдера товаров.
+# Список товаров раздела (или бренда в разделе) — товары в наличии в порядке
+# (минимальная цена, id). Читается только таблица products: цену, наличие и обложку
+# держат в сводных колонках триггеры (см. schema.py), порядок отдаёт частичный индекс.
+# Слайдер берёт одну строку текущей страницы (LIMIT 1 OFFSET),
+# а количество страниц — из кеша счётчиков в памяти.
+# brand_id=None — режим "все товары раздела".
+#
+# Любая запись, меняющая каталог или остатки, должна вызвать
+# invalidate_listings() ПОСЛЕ коммита.
+
+# (sub_category_id, brand_id) -> количество товаров в наличии
+_counts = {}
+# Растёт при каждой инвалидации: счётчик, посчитанный до инвалидации, в кеш не кладём
+_generation = 0
+
+
+def _listing_filter(subcat_id, brand_id, alias="p"):
+    """Ключ кеша и условие WHERE (с параметрами) для списка товаров слайдера."""
+    key = (int(subcat_id), int(brand_id) if brand_id is not None else None)
+    if key[1] is None:
+        return key, f"{alias}.sub_category_id = ? AND {alias}.total_quantity > 0", (key[0],)
+    return key, f"{alias}.sub_category_id = ? AND {alias}.brand_id = ? AND {alias}.total_quantity > 0", key
+
+
+# Запросы слайдера: SQL и параметры. Отдельно от выполнения, чтобы check_query_plans.py
+# проверял планы ровно тех запросов, которые выполняет бот.
+
+def _count_query(subcat_id, brand_id=None):
+    _, where, params = _listing_filter(subcat_id, brand_id)
+    return f"SELECT COUNT(*) FROM products p WHERE {where}", params
+
+
+def _page_query(subcat_id, brand_id=None, page=0):
+    _, where, params = _listing_filter(subcat_id, brand_id)
+    return f"""
+        SELECT p.id, p.name, p.sku, p.min_price, b.name as brand, p.first_file_id, p.first_is_video
+        FROM products p
+        JOIN brands b ON p.brand_id = b.id
+        WHERE {where}
+        ORDER BY p.min_price, p.id
+        LIMIT 1 OFFSET ?
+    """, params + (int(page),)
+
+
+def _position_query(subcat_id, brand_id, product_id):
+    _, where, params = _listing_filter(subcat_id, brand_id)
+    _, target_where, _ = _listing_filter(subcat_id, brand_id, alias="t")
+    return f"""
+        SELECT (
+            SELECT COUNT(*) FROM products p
+            WHERE {where} AND (p.min_price, p.id) < (t.min_price, t.id)
+        ) AS position
+        FROM products t
+        WHERE t.id = ? AND {target_where}
+    """, params + (int(product_id),) + params
+
+
+async def count_products(subcat_id, brand_id=None):
+    """Сколько товаров в слайдере — из кеша или одним COUNT по индексу."""
+    key, _, _ = _listing_filter(subcat_id, brand_id)
+    total = _counts.get(key)
+    if total is not None:
+        return total
+
+    generation = _generation
+    row = await fetchone(*_count_query(subcat_id, brand_id))
+    total = row[0]
+    if generation == _generation:
+        _counts[key] = total
+    return total
+
+
+async def get_product_page(subcat_id, brand_id=None, page=0):
+    """Товар на странице page слайдера или None.
+
+    dict с id, name, sku, min_price, brand, first_file_id, first_is_video.
+    """
+    row = await fetchone(*_page_query(subcat_id, brand_id, page))
+    return dict(row) if row else None
+
+
+async def get_product_position(subcat_id, brand_id, product_id):
+    """Номер страницы товара в слайдере или None, если товара в нём нет."""
+    row = await fetchone(*_position_query(subcat_id, brand_id, product_id))
+    return row['position'] if row else None
+
+
+def invalidate_listings(subcat_id=None):
+    """Сбрасывает кеш счётчиков слайдера: для одного раздела или (по умолчанию) целиком."""
+    global _generation
+    _generation += 1
+    if subcat_id is None:
+        _counts.clear()
+    else:
+        for key in [key for key in _counts if key[0] == int(subcat_id)]:
+            del _counts[key]
+    # Цены и наличие видны и в результатах инлайн-поиска, и в проверках корзины
+    invalidate_search()
+    invalidate_stock()
+    logging.debug(f"Кеш слайдера сброшен (раздел: {subcat_id or 'все'})")
@@ -0,0 +1,113 @@
+import sys
+import sqlite3
+from configs import DB_FILE
+from db import ORDER_ITEMS_SQL
+from bee import _orders_report_query
+from carts import CART_SQL, CART_LINES_SQL
+from catalog_cache import _count_query, _page_query, _position_query
+from client_handlers import SUBCATEGORIES_SQL, BRANDS_SQL, COLORS_SQL, SIZES_SQL, MEDIA_SQL
+from admin_handlers_newupdate import ORDER_HISTORY_SQL
+from reservations import RELEASE_SQL, SWEEP_SQL
+from sales import DAILY_SALES_SQL, TOP_SELLERS_SQL
+from search import SEARCH_SQL, SEARCH_PAGE_SIZE
+
+# Горячие запросы, для которых проверяем, что SQLite не переходит на полный просмотр
+# таблицы (SCAN): (название, SQL, параметры). SQL берётся из модулей, которые его
+# выполняют, поэтому проверяются ровно те запросы, что идут в работе.
+HOT_QUERIES = (
+    ("Слайдер: страница (все товары раздела)", *_page_query(1, None, 0)),
+    ("Слайдер: страница (товары бренда)", *_page_query(1, 1, 0)),
+    ("Слайдер: количество товаров бренда в разделе", *_count_query(1, 1)),
+    ("Слайдер: позиция товара", *_position_query(1, None, 1)),
+    ("Бренды раздела", BRANDS_SQL, (1,)),
+    ("Разделы категории", SUBCATEGORIES_SQL, (1,)),
+    ("Цвета товара", COLORS_SQL, (1,)),
+    ("Размеры цвета", SIZES_SQL, (1, 1)),
+    ("Медиа цвета", MEDIA_SQL, ("[1, 2]",)),
+    ("Инлайн-поиск", SEARCH_SQL, ('"nike"*', SEARCH_PAGE_SIZE + 1, SEARCH_PAGE_SIZE)),
+    ("История заказов", ORDER_HISTORY_SQL, (1,)),
+    ("Отчёт по заказам за период",
+     *_orders_report_query(date_from="2025-01-01 00:00:00", date_to="2025-02-01 00:00:00")),
+    ("Отчёт по заказам с прошлой выгрузки", *_orders_report_query(after_id=100, up_to_id=200)),
+    ("Отчёт о продажах: итоги по дням", DAILY_SALES_SQL, ("2025-01-01",)),
+    ("Отчёт о продажах: хиты", TOP_SELLERS_SQL, ("2025-01-01", 5)),
+    ("Корзина покупателя", CART_SQL, (1,)),
+    ("Корзина: варианты для показа", CART_LINES_SQL, ("[1, 2]",)),
+    ("Резервы: просроченные", SWEEP_SQL, ()),
+    ("Резервы заказа", RELEASE_SQL, (1,)),
+    ("Состав заказа", ORDER_ITEMS_SQL, (1,)),
+)
+
+# Строки плана вида "SCAN <таблица>" означают полный просмотр таблицы или индекса.
+# "SCAN CONSTANT ROW" — это не чтение таблицы, его пропускаем.
+ALLOWED_SCANS = ("SCAN CONSTANT ROW",)
+# Промежуточные результаты подзапросов и CTE: их просмотр — не просмотр таблицы
+SUBQUERY_PREFIXES = ("MATERIALIZE ", "CO-ROUTINE ")
+# Табличные функции над параметром запроса (список id в JSON): просматривается сам параметр
+PARAMETER_SCANS = ("SCAN json_each ", "SCAN json_tree ")
+
+
+def find_full_scans(conn):
+    """Возвращает [(название запроса, строка плана)] для всех горячих запросов с полным просмотром."""
+    problems = []
+    for title, sql, params in HOT_QUERIES:
+        plan = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()]
+        subqueries = {
+            detail.split(" ", 1)[1] for detail in plan if detail.startswith(SUBQUERY_PREFIXES)
+        }
+        for detail in plan:
+            if not detail.startswith("SCAN") or detail.startswith(ALLOWED_SCANS + PARAMETER_SCANS):
+                continue
+            target = detail[len("SCAN "):]
+            if target in subqueries or target.startswith("(subquery-"):
+                continue
+            # Виртуальная таблица (FTS5) с ограничением, например "INDEX 0:M5" — поиск по MATCH;
+            # пустая строка после двоеточия означает полный просмотр
+            if " VIRTUAL TABLE INDEX " in detail and not detail.endswith(":"):
+                continue
+            problems.append((title, detail))
+    return problems
+
+
+def schema_copy(db_path):
+    """Пустая копия схемы базы в памяти.
+
+    Планы проверяем на ней, а не на самой базе: на маленьких таблицах и со статистикой
+    ANALYZE SQLite законно выбирает SCAN, и проверка зависела бы от объёма данных.
+    """
+    source = sqlite3.connect(db_path)
+    try:
+        rows = source.execute(
+            "SELECT name, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+            "ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END"
+        ).fetchall()
+    finally:
+        source.close()
+    # Служебные таблицы FTS5 (products_fts_data и т.п.) создаёт сама виртуальная таблица
+    virtual = [name for name, sql in rows if sql.upper().startswith("CREATE VIRTUAL TABLE")]
+    conn = sqlite3.connect(":memory:")
+    for name, sql in rows:
+        if any(name.startswith(f"{table}_") for table in virtual):
+            continue
+        conn.execute(sql)
+    return conn
+
+
+def main(db_path):
+    conn = schema_copy(db_path)
+    try:
+        problems = find_full_scans(conn)
+    finally:
+        conn.close()
+
+    if problems:
+        print("❌ Горячие запросы с полным просмотром таблиц:")
+        for title, detail in problems:
+            print(f"  • {title}: {detail}")
+        return 1
+    print(f"✅ Все {len(HOT_QUERIES)} горячих запросов используют индексы ({db_path}).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else DB_FILE))
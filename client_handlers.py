@@ -12,7 +12,12 @@ from telegram import  InputFile
 from telegram.constants import ParseMode
 from telegram.helpers import escape_markdown
 from configs import ADMIN_IDS, ITEMS_PER_PAGE
-from db import fetchall, fetchone, execute
+from db import fetchall, fetchone, execute, transaction, fetch_order_items
+from carts import get_cart, add_item, change_quantity, clear_cart as clear_cart_items, forget_cart, cart_lines, adopt_legacy_cart
+from stock_cache import get_stock
+from reservations import reserve_stock, cancel_order, extend_reservation, OutOfStock
+from search import search_products, cached_search, parse_offset
+from catalog_cache import count_products, get_product_page, get_product_position, invalidate_listings
 from datetime import datetime
 import time
 from datetime import datetime, timezone
@@ -20,6 +25,29 @@ ASK_NAME, ASK_ADDRESS, ASK_PHONE = range(3)
 import telegram.error
 import logging
 
+# Запросы каталога, которые выполняются на каждое нажатие; их планы проверяет check_query_plans.py
+SUBCATEGORIES_SQL = "SELECT * FROM sub_categories WHERE category_id = ?"
+BRANDS_SQL = """
+    SELECT DISTINCT b.id, b.name
+    FROM products p
+    JOIN brands b ON p.brand_id = b.id
+    WHERE p.sub_category_id = ?
+"""
+COLORS_SQL = """
+    SELECT DISTINCT c.id, c.name
+    FROM product_variants pv
+    JOIN colors c ON pv.color_id = c.id
+    WHERE pv.product_id = ? AND pv.quantity > pv.reserved
+"""
+SIZES_SQL = """
+    SELECT DISTINCT s.id, s.name
+    FROM product_variants pv
+    JOIN sizes s ON pv.size_id = s.id
+    WHERE pv.product_id = ? AND pv.color_id = ? AND pv.quantity > pv.reserved
+"""
+# Фото/видео вариантов цвета; id вариантов — JSON-список
+MEDIA_SQL = 'SELECT file_id, is_video FROM product_media WHERE variant_id IN (SELECT value FROM json_each(?)) ORDER BY "order"'
+
 def md2(text):
     """
     Экспортирует спецсимволы для MarkdownV2, но не трогает обычный текст.
@@ -111,7 +139,7 @@ async def show_subcategories(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     category_id = int(query.data.split('_')[1])
     context.user_data['current_category_id'] = category_id
-    sub_categories = await fetchall("SELECT * FROM sub_categories WHERE category_id = ?", (category_id,))
+    sub_categories = await fetchall(SUBCATEGORIES_SQL, (category_id,))
     keyboard = [[InlineKeyboardButton(md2(scat['name']), callback_data=f"subcat_{scat['id']}")] for scat in sub_categories]
     keyboard.append([InlineKeyboardButton(md2("◀️ Назад к категориям"), callback_data="back_to_main_cat")])
     try:
@@ -139,12 +167,7 @@ async def show_brand_or_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Ошибка: не удалось определить id раздела.")
         return
     context.user_data['current_subcat_id'] = subcat_id
-    brands = await fetchall("""
-        SELECT DISTINCT b.id, b.name
-        FROM products p
-        JOIN brands b ON p.brand_id = b.id
-        WHERE p.sub_category_id = ?
-    """, (subcat_id,))
+    brands = await fetchall(BRANDS_SQL, (subcat_id,))
     keyboard = [
         [InlineKeyboardButton(md2(b['name']), callback_data=f"brand_{subcat_id}_{b['id']}")] for b in brands
     ]
@@ -177,12 +200,7 @@ async def back_to_brands(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.message.delete()
     except Exception:
         pass
-    brands = await fetchall("""
-        SELECT DISTINCT b.id, b.name
-        FROM products p
-        JOIN brands b ON p.brand_id = b.id
-        WHERE p.sub_category_id = ?
-    """, (subcat_id,))
+    brands = await fetchall(BRANDS_SQL, (subcat_id,))
     keyboard = [
         [InlineKeyboardButton(md2(b['name']), callback_data=f"brand_{subcat_id}_{b['id']}")] for b in brands
     ]
@@ -273,41 +291,23 @@ async def show_product_slider(update: Update, context: ContextTypes.DEFAULT_TYPE
     page = int(user_data.get('product_slider_page', 0))
     await asyncio.sleep(0.5)
 
-    # Получение товаров
-    if all_mode:
-        products = await fetchall("""
-            SELECT p.id, p.name,p.sku, MIN(pv.price) as min_price, b.name as brand
-            FROM products p
-            JOIN product_variants pv ON p.id = pv.product_id
-            JOIN brands b ON p.brand_id = b.id
-            WHERE p.sub_category_id = ? AND pv.quantity > 0
-            GROUP BY p.id
-            ORDER BY min_price
-        """, (subcat_id,))
-    else:
-        if not brand_id:
-            await safe_delete_and_send(query, "Ошибка: не определён бренд.", context)
-            return
-        products = await fetchall("""
-            SELECT p.id, p.name,p.sku, MIN(pv.price) as min_price, b.name as brand
-            FROM products p
-            JOIN product_variants pv ON p.id = pv.product_id
-            JOIN brands b ON p.brand_id = b.id
-            WHERE p.sub_category_id = ? AND p.brand_id = ? AND pv.quantity > 0
-            GROUP BY p.id
-            ORDER BY min_price
-        """, (subcat_id, brand_id))
+    # Получение товара текущей страницы: одна строка из БД + количество из кеша (см. catalog_cache.py)
+    if not all_mode and not brand_id:
+        await safe_delete_and_send(query, "Ошибка: не определён бренд.", context)
+        return
+    listing_brand_id = None if all_mode else brand_id
+
+    total = await count_products(subcat_id, listing_brand_id)
+    page = max(0, min(page, total - 1))
+    product = await get_product_page(subcat_id, listing_brand_id, page) if total else None
 
-    if not products:
+    if not product:
         await safe_delete_and_send(query, md2("Нет товаров!"), context)
         return
 
-    total = len(products)
-    page = max(0, min(page, total - 1))
     user_data['product_slider_page'] = page
     user_data['all_mode'] = all_mode
 
-    product = products[page]
     product_id = product['id']
     user_data['current_product_id'] = product_id
 
@@ -321,14 +321,9 @@ async def show_product_slider(update: Update, context: ContextTypes.DEFAULT_TYPE
             if result:
                 user_data['current_category_id'] = result['category_id']
 
-    # Медиа
-    media_row = await fetchone("""
-        SELECT file_id, is_video FROM product_media
-        WHERE variant_id = (SELECT id FROM product_variants WHERE product_id = ? LIMIT 1)
-        ORDER BY "order" LIMIT 1
-    """, (product_id,))
-    file_id = media_row['file_id'] if media_row else None
-    is_video = bool(media_row['is_video']) if media_row else False
+    # Медиа — обложка товара уже в сводных колонках products
+    file_id = product['first_file_id']
+    is_video = bool(product['first_is_video'])
 
     # Текст карточки
     caption = (
@@ -520,28 +515,9 @@ async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYP
 
     slider_page = None
     if subcat_id:
-        if all_mode:
-            product_list = await fetchall("""
-                SELECT p.id FROM products p
-                JOIN product_variants pv ON p.id = pv.product_id
-                WHERE p.sub_category_id = ? AND pv.quantity > 0
-                GROUP BY p.id
-                ORDER BY MIN(pv.price)
-            """, (subcat_id,))
-        else:
-            product_list = await fetchall("""
-                SELECT p.id FROM products p
-                JOIN product_variants pv ON p.id = pv.product_id
-                WHERE p.sub_category_id = ? AND p.brand_id = ? AND pv.quantity > 0
-                GROUP BY p.id
-                ORDER BY MIN(pv.price)
-            """, (subcat_id, brand_id))
-
-        for i, item in enumerate(product_list):
-            if item['id'] == product_id:
-                slider_page = i
-                context.user_data['product_slider_page'] = i
-                break
+        slider_page = await get_product_position(subcat_id, None if all_mode else brand_id, product_id)
+        if slider_page is not None:
+            context.user_data['product_slider_page'] = slider_page
 
     if slider_page is not None:
         context.user_data['return_to_slider'] = {
@@ -558,12 +534,7 @@ async def show_product_details(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     # 🎨 Цвета
-    colors = await fetchall("""
-        SELECT DISTINCT c.id, c.name
-        FROM product_variants pv
-        JOIN colors c ON pv.color_id = c.id
-        WHERE pv.product_id = ? AND pv.quantity > 0
-    """, (product_id,))
+    colors = await fetchall(COLORS_SQL, (product_id,))
 
     if not colors:
         await safe_edit_or_send(update, md2("Нет доступных цветов для этого товара."), context=context)
@@ -582,12 +553,10 @@ async def get_color_media(product_id, color_id):
         "SELECT id FROM product_variants WHERE product_id = ? AND color_id = ?",
         (product_id, color_id)
     )
-    variant_ids = [str(row['id']) for row in variant_ids]
+    variant_ids = [row['id'] for row in variant_ids]
     if not variant_ids:
         return []
-    ids_str = ",".join(variant_ids)
-    query = f"SELECT file_id, is_video FROM product_media WHERE variant_id IN ({ids_str}) ORDER BY \"order\""
-    return await fetchall(query)
+    return await fetchall(MEDIA_SQL, (json.dumps(variant_ids),))
 
 
 async def choose_color(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -609,12 +578,7 @@ async def choose_color(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['color_photo_page'] = page
 
     # --- Осы түске сәйкес размерлерді іздеу ---
-    sizes = await fetchall("""
-        SELECT DISTINCT s.id, s.name
-        FROM product_variants pv
-        JOIN sizes s ON pv.size_id = s.id
-        WHERE pv.product_id = ? AND pv.color_id = ? AND pv.quantity > 0
-    """, (product_id, color_id))
+    sizes = await fetchall(SIZES_SQL, (product_id, color_id))
 
     # --- МЕДИА (фото/видео) алу ---
     media_rows = await get_color_media(product_id, color_id) # get_color_media функциясы сенде бар
@@ -633,12 +597,12 @@ async def choose_color(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ЕГЕР РАЗМЕРЛЕР ТАБЫЛМАСА (бұл сағат немесе аксессуар)
     if not sizes:
         variant = await fetchone("""
-            SELECT pv.*, c.name as color, b.name as brand, p.name as product_name, p.sku
+            SELECT pv.*, pv.quantity - pv.reserved AS available, c.name as color, b.name as brand, p.name as product_name, p.sku
             FROM product_variants pv
             JOIN colors c ON pv.color_id = c.id
             JOIN products p ON pv.product_id = p.id
             JOIN brands b ON p.brand_id = b.id
-            WHERE pv.product_id = ? AND pv.color_id = ? AND pv.quantity > 0
+            WHERE pv.product_id = ? AND pv.color_id = ? AND pv.quantity > pv.reserved
             LIMIT 1
         """, (product_id, color_id))
 
@@ -651,7 +615,7 @@ async def choose_color(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"Бренд: {variant['brand']}\n"
             f"Цвет: {variant['color']}\n"
             f"Цена: {variant['price']}₸\n"
-            f"В наличии: {variant['quantity']} шт.\n"
+            f"В наличии: {variant['available']} шт.\n"
             f"Код товара: <pre>{variant['sku']}</pre>\n\n"
             f"Фото {page + 1}/{total_media}"
         )
@@ -748,13 +712,13 @@ async def choose_size(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['current_brand_id'] = product['brand_id']
 
     variant = await fetchone("""
-    SELECT pv.*, s.name as size, c.name as color, b.name as brand, p.brand_id
+    SELECT pv.*, pv.quantity - pv.reserved AS available, s.name as size, c.name as color, b.name as brand, p.brand_id
     FROM product_variants pv
     JOIN sizes s ON pv.size_id = s.id
     JOIN colors c ON pv.color_id = c.id
     JOIN products p ON pv.product_id = p.id
     JOIN brands b ON p.brand_id = b.id
-    WHERE pv.product_id = ? AND pv.color_id = ? AND pv.size_id = ? AND pv.quantity > 0
+    WHERE pv.product_id = ? AND pv.color_id = ? AND pv.size_id = ? AND pv.quantity > pv.reserved
     LIMIT 1
 """, (product_id, color_id, size_id))
 
@@ -763,7 +727,7 @@ async def choose_size(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     product = await fetchone("SELECT name FROM products WHERE id = ?", (product_id,))
     text = (
-        f"<b>{product['name']}</b>\n \n<i>Бренд:</i> <b><i>{variant['brand']}</i></b>\n<i>Цвет:</i> <b><i>{variant['color']}</i></b>\n<i>Размер:</i> <b><i>{variant['size']}</i></b>\n<i>Цена:</i> <b><i>{variant['price']}₸</i></b>\n<i>В наличии:</i> <b><i>{variant['quantity']} шт.</i></b>\n\n"
+        f"<b>{product['name']}</b>\n \n<i>Бренд:</i> <b><i>{variant['brand']}</i></b>\n<i>Цвет:</i> <b><i>{variant['color']}</i></b>\n<i>Размер:</i> <b><i>{variant['size']}</i></b>\n<i>Цена:</i> <b><i>{variant['price']}₸</i></b>\n<i>В наличии:</i> <b><i>{variant['available']} шт.</i></b>\n\n"
     )
     keyboard = [
         [InlineKeyboardButton(md2("✅ Добавить в корзину"), callback_data=f"add_{variant['id']}")],
@@ -792,16 +756,7 @@ async def back_to_slider(update: Update, context: ContextTypes.DEFAULT_TYPE, sub
     if all_mode:
         await show_product_slider(update, context, subcat_id=subcat_id, all_mode=True)
     elif brand_id is not None:
-        products = await fetchall(
-            """
-            SELECT p.id FROM products p
-            JOIN product_variants pv ON p.id = pv.product_id
-            WHERE p.sub_category_id = ? AND p.brand_id = ? AND pv.quantity > 0
-            GROUP BY p.id
-            """,
-            (subcat_id, brand_id)
-        )
-        if products:
+        if await count_products(subcat_id, brand_id):
             await show_product_slider(update, context, brand_id=brand_id, all_mode=False)
         else:
             await show_product_slider(update, context, subcat_id=subcat_id, all_mode=False)
@@ -813,16 +768,8 @@ async def back_to_slider(update: Update, context: ContextTypes.DEFAULT_TYPE, sub
 
 
 async def add_item_to_cart(context: ContextTypes.DEFAULT_TYPE, product_variant_id, chat_id, query=None):
-    # --- ТҮЗЕТІЛГЕН SQL-ЗАПРОС ---
-    variant = await fetchone("""
-        SELECT pv.id, pv.quantity, p.name, pv.price, s.name as size, c.name as color, p.brand_id, b.name as brand
-        FROM product_variants pv
-        JOIN products p ON pv.product_id = p.id
-        LEFT JOIN sizes s ON pv.size_id = s.id 
-        JOIN colors c ON pv.color_id = c.id
-        JOIN brands b ON p.brand_id = b.id
-        WHERE pv.id = ?
-    """, (product_variant_id,))
+    # Название и цена в корзине не хранятся — здесь нужен только остаток (из снимка в памяти)
+    variant = await get_stock(product_variant_id)
 
     if not variant or variant['quantity'] <= 0:
         msg = "❌ Этот вариант товара закончился на складе."
@@ -832,11 +779,10 @@ async def add_item_to_cart(context: ContextTypes.DEFAULT_TYPE, product_variant_i
             await context.bot.send_message(chat_id=chat_id, text=msg)
         return False
 
-    cart = context.user_data.setdefault('cart', {})
-    variant_id_str = str(product_variant_id)
-    current_quantity = cart.get(variant_id_str, {}).get('quantity', 0)
-
-    if current_quantity >= variant['quantity']:
+    # Корзина — в таблице carts (carts.py); +1 атомарно и не больше остатка на складе
+    user_id = query.from_user.id if query else chat_id
+    await adopt_legacy_cart(user_id, context.user_data)
+    if await add_item(user_id, int(product_variant_id), variant['quantity']) is None:
         msg = "Вы уже добавили в корзину всё, что есть в наличии!"
         if query:
             await query.answer(msg, show_alert=True)
@@ -844,27 +790,13 @@ async def add_item_to_cart(context: ContextTypes.DEFAULT_TYPE, product_variant_i
             await context.bot.send_message(chat_id=chat_id, text=msg)
         return False
 
-    # --- ТҮЗЕТІЛГЕН ТАУАР АТЫН ҚҰРАСТЫРУ ---
-    # Размердің бар-жоғын тексереміз
-    if variant['size']:
-        full_name = f"{variant['name']} ({variant['size']}, {variant['color']})"
-    else: # Егер размер болмаса
-        full_name = f"{variant['name']} ({variant['color']})"
-
-    if variant_id_str in cart:
-        cart[variant_id_str]['quantity'] += 1
-    else:
-        cart[variant_id_str] = {
-            'name': full_name, 
-            'price': variant['price'], 
-            'quantity': 1, 
-            'brand': variant['brand']
-        }
-        
     return True
 
 async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE , edit=True):
-    cart = context.user_data.setdefault('cart', {})
+    user_id = update.effective_user.id
+    await adopt_legacy_cart(user_id, context.user_data)
+    # Названия, цены и бренды подставляются из каталога при показе
+    cart = await cart_lines(user_id)
     chat_id = update.effective_chat.id
     
 
@@ -889,7 +821,8 @@ async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE , edit=Tr
         total_price = 0
         keyboard = []
 
-        for variant_id_str, item in cart.items():
+        for item in cart:
+            variant_id_str = str(item['variant_id'])
             item_total = item['price'] * item['quantity']
             total_price += item_total
 
@@ -969,7 +902,7 @@ async def reply_cart_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def clear_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    context.user_data['cart'] = {}  # безопаснее, чем pop()
+    await clear_cart_items(update.effective_user.id)
     kb = [[InlineKeyboardButton("◀ Назад", callback_data="back_from_cart")]]
     await safe_edit_or_send(query, md2("🛒 Ваша корзина очищена."), context , reply_markup=InlineKeyboardMarkup(kb))
 
@@ -978,16 +911,16 @@ async def cart_plus(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    variant_id = query.data.split('_')[2]
-    cart = context.user_data.setdefault('cart', {})
-    item = cart.get(variant_id)
-    
-    if not item:
+    user_id = update.effective_user.id
+    variant_id = int(query.data.split('_')[2])
+    cart = await get_cart(user_id)
+
+    if variant_id not in cart:
         await query.answer("❌ Товар не найден в корзине.", show_alert=True)
         return
 
     try:
-        variant = await fetchone("SELECT quantity FROM product_variants WHERE id = ?", (variant_id,))
+        variant = await get_stock(variant_id)
     except Exception as e:
         await query.answer("⚠️ Ошибка при проверке наличия.", show_alert=True)
         return
@@ -996,12 +929,10 @@ async def cart_plus(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("❌ Товар больше недоступен.", show_alert=True)
         return
 
-    if item['quantity'] >= variant['quantity']:
+    if await change_quantity(user_id, variant_id, +1, limit=variant['quantity']) is None:
         await query.answer("📦 Больше нет в наличии!", show_alert=True)
         return
 
-    item['quantity'] += 1
-
     try:
         await show_cart(update, context , edit= True)
     except Exception as e:
@@ -1012,18 +943,13 @@ async def cart_minus(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    variant_id = query.data.split('_')[2]
-    cart = context.user_data.setdefault('cart', {})
+    variant_id = int(query.data.split('_')[2])
 
-    if variant_id not in cart:
+    # При нуле позиция удаляется из корзины
+    if await change_quantity(update.effective_user.id, variant_id, -1) is None:
         await query.answer("❌ Товар не найден.", show_alert=True)
         return
 
-    cart[variant_id]['quantity'] -= 1
-
-    if cart[variant_id]['quantity'] <= 0:
-        del cart[variant_id]
-
     try:
         await show_cart(update, context, edit=True)
     except Exception as e:
@@ -1106,14 +1032,12 @@ async def start_checkout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     data = query.data.split('_')[0] if query.data else None
-    cart = context.user_data.get("cart", {})
-    if not isinstance(cart, dict) or not cart:
+    await adopt_legacy_cart(update.effective_user.id, context.user_data)
+    if not await get_cart(update.effective_user.id):
         await safe_edit_or_send(query, md2("🛒 Ваша корзина пуста.") , parse_mode="MarkdownV2")
         return ConversationHandler.END
     kb = [[InlineKeyboardButton(md2("❌ Отменить"), callback_data="cancel_checkout")],]
     
-    context.user_data['checkout_cart'] = cart  # Сохраняем корзину для дальнейшего использования
-   
     await safe_edit_or_send(query, md2("Для оформления заказа, пожалуйста, введите ваше имя"), parse_mode="MarkdownV2", context=context , reply_markup=InlineKeyboardMarkup(kb))
     return ASK_NAME
 
@@ -1127,40 +1051,83 @@ async def ask_address(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(md2("Спасибо! И последнее, ваш контактный номер"), parse_mode="MarkdownV2")
     return ASK_PHONE
 
+async def _reply_cart_short(update, user_id, lines):
+    """Урезает корзину до свободных остатков и просит оформить заказ заново."""
+    short = [item for item in lines if item['quantity'] > item['stock']]
+    for item in short:
+        await change_quantity(user_id, item['variant_id'], max(item['stock'], 0) - item['quantity'])
+    short_text = "\n".join(
+        f"• {item['name']}: в наличии {max(item['stock'], 0)} шт." for item in short
+    )
+    kb = [[InlineKeyboardButton("🛒 Посмотреть корзину", callback_data="cart")]]
+    await update.message.reply_text(
+        md2(f"⚠️ Пока вы оформляли заказ, часть товаров закончилась:\n{short_text}\n\n"
+            "Корзина обновлена — проверьте её и оформите заказ заново."),
+        parse_mode="MarkdownV2", reply_markup=InlineKeyboardMarkup(kb)
+    )
+    return ConversationHandler.END
+
+
 async def ask_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["checkout_phone"] = update.message.text
     user_id = update.effective_user.id
     name = context.user_data["checkout_name"]
     address = context.user_data["checkout_address"]
     phone = context.user_data["checkout_phone"]
-    cart = context.user_data.get("cart", {})
+    # Цены — актуальные на момент оформления
+    lines = await cart_lines(user_id)
     
-    if not isinstance(cart, dict) or not cart:
+    if not lines:
         await update.message.reply_text(md2("Ваша корзина пуста."), parse_mode="MarkdownV2")
         return ConversationHandler.END
 
+    # Проверка свободных остатков по БД (cart_lines читает их оттуда, а не из снимка).
+    # Окончательная — резерв в транзакции заказа ниже.
+    if any(item['quantity'] > item['stock'] for item in lines):
+        return await _reply_cart_short(update, user_id, lines)
+
+    cart = {
+        str(item['variant_id']): {
+            'name': item['name'], 'price': item['price'], 'quantity': item['quantity'], 'brand': item['brand'],
+        }
+        for item in lines
+    }
     cart_json = json.dumps(cart, ensure_ascii=False)
     total_price = sum(item['price'] * item['quantity'] for item in cart.values())
     
     try:
-        # --- ТҮЗЕТІЛГЕН SQL-ЗАПРОС ---
-        # `brand` деген бағананы алып тастадық
-        order_id = await execute(
-            "INSERT INTO orders (user_id, user_name, user_address, user_phone, cart, total_price, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (user_id, name, address, phone, cart_json, total_price, 'pending_payment')
-        )
-        # --- ТҮЗЕТУДІҢ СОҢЫ ---
+        # Заказ, его состав (order_items), резерв остатков и очистку корзины пишем одной транзакцией:
+        # если резерв не прошёл (остаток забрали другие), заказ не создаётся.
+        # Колонку cart продолжаем заполнять для совместимости, но читаем состав из order_items.
+        async with transaction() as tx:
+            order_id = await tx.execute(
+                "INSERT INTO orders (user_id, user_name, user_address, user_phone, cart, total_price, status) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (user_id, name, address, phone, cart_json, total_price, 'pending_payment')
+            )
+            await tx.executemany(
+                "INSERT INTO order_items (order_id, variant_id, name, brand, price, quantity) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (order_id, int(variant_id_str), item['name'], item.get('brand'), item['price'], item['quantity'])
+                    for variant_id_str, item in cart.items()
+                ]
+            )
+            await reserve_stock(tx, order_id, {int(v): item['quantity'] for v, item in cart.items()})
+            await clear_cart_items(user_id, tx)
+        forget_cart(user_id)  # корзина очищена только теперь, после коммита
+        invalidate_listings()  # свободный остаток изменился
 
+    except OutOfStock:
+        return await _reply_cart_short(update, user_id, await cart_lines(user_id))
     except Exception as e:
         print(f"❌ Ошибка при сохранении заказа в БД: {e}")
         await update.message.reply_text(md2("Произошла ошибка при оформлении заказа."), parse_mode="MarkdownV2")
         return ConversationHandler.END
     
     # --- Чекті құрастыру ---
-    cart_lines = []
+    receipt_lines = []
     for item in cart.values():
-        cart_lines.append(f"{item['name']} x{item['quantity']} = {item['price']*item['quantity']}₸\nБренд: {item.get('brand', 'Не указано')}")
-    cart_text = "\n".join(cart_lines)
+        receipt_lines.append(f"{item['name']} x{item['quantity']} = {item['price']*item['quantity']}₸\nБренд: {item.get('brand', 'Не указано')}")
+    cart_text = "\n".join(receipt_lines)
     
     receipt_text = (
         f"🧾 <b>Ваш чек №{order_id}</b>\n\n"
@@ -1190,7 +1157,6 @@ async def ask_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
         message_text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(keyboard), disable_web_page_preview=True
     )
     
-    context.user_data.pop('cart', None)
     return ConversationHandler.END
 
 
@@ -1217,35 +1183,26 @@ async def confirm_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     order_id = int(query.data.split('_')[-1])
 
-    
-
-    await query.edit_message_text(f"❌ Ваш заказ {md2(order_id)} был отменён.")
     order = await fetchone("SELECT * FROM orders WHERE id = ?", (order_id,))
     if not order or order["status"] in ("delivered", "cancelled_by_client", "rejected"):
         await query.edit_message_text("⚠️ Заказ уже не может быть отменён.")
         return
     
-    # Если товар уже списан — вернём его обратно на склад
-    if order["deducted_from_stock"] == 1:
-
-        try:
-            cart = json.loads(order["cart"])
-            for variant_id_str, item in cart.items():
-                await execute(
-                    "UPDATE product_variants SET quantity = quantity + ? WHERE id = ?",
-                    (item['quantity'], int(variant_id_str))
-                )
-            await execute("UPDATE orders SET deducted_from_stock = 0 WHERE id = ?", (order_id,))
-        except Exception as e:
-            await query.edit_message_text(f"❌ Ошибка при возврате товаров на склад: {e}")
-            return
+    items = await fetch_order_items(order_id)
 
-    # Обновляем статус
-    await execute("UPDATE orders SET status = ? WHERE id = ?", ("cancelled_by_client", order_id))
+    # Если товар уже списан — вернём его обратно на склад; вместе со статусом — одной транзакцией
+    try:
+        cancelled = await cancel_order(order_id, items, "cancelled_by_client")
+    except Exception as e:
+        await query.edit_message_text(f"❌ Ошибка при возврате товаров на склад: {e}")
+        return
+    if not cancelled:
+        await query.edit_message_text("⚠️ Заказ уже не может быть отменён.")
+        return
+    await query.edit_message_text(f"❌ Ваш заказ {md2(order_id)} был отменён.")
 
     # Информация о заказе для админа
-    cart = json.loads(order['cart'])
-    cart_text = "\n".join([f"• {md2(item['name'])} \(x{md2(item['quantity'])}\)" for item in cart.values()])
+    cart_text = "\n".join([f"• {md2(item['name'])} \(x{md2(item['quantity'])}\)" for item in items])
 
     user_link = f"[@{md2(update.effective_user.username)}](https://t.me/{md2(update.effective_user.username)})" if update.effective_user.username else md2("нет username")
 
@@ -1279,8 +1236,8 @@ async def back_to_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
 
-    cart = json.loads(order['cart'])
-    cart_text = "\n".join([f"• {item['name']} x{item['quantity']} = {item['price'] * item['quantity']}₸" for item in cart.values()])
+    items = await fetch_order_items(order_id)
+    cart_text = "\n".join([f"• {item['name']} x{item['quantity']} = {item['price'] * item['quantity']}₸" for item in items])
     
     kaspi_link = "https://pay.kaspi.kz/pay/f9ja8t7g"
     message_text = (
@@ -1313,11 +1270,12 @@ async def process_payment_confirmation(query, context):
     order = await fetchone("SELECT * FROM orders WHERE id = ?", (order_id,))
     if order and order['status'] == 'pending_payment':
         await execute("UPDATE orders SET status = ? WHERE id = ?", ('pending_verification', order_id))
-        cart = json.loads(order['cart'])
+        await extend_reservation(order_id)  # держим товар, пока админ проверяет оплату
+        items = await fetch_order_items(order_id)
 
         cart_text = "\n".join([
-            f"• {md2(item['name'])} \\(x{md2(item['quantity'])}\\)\nБренд: {md2(item.get('brand', 'Не указано'))}"
-            for item in cart.values()
+            f"• {md2(item['name'])} \\(x{md2(item['quantity'])}\\)\nБренд: {md2(item['brand'] or 'Не указано')}"
+            for item in items
         ])
 
         user_id = order['user_id']
@@ -1386,44 +1344,44 @@ def escape_html(text: str) -> str:
 from telegram import InlineQueryResultArticle, InputTextMessageContent, InlineKeyboardMarkup, InlineKeyboardButton
 
 
+# Поиск, который сейчас выполняется для пользователя: новый запрос отменяет предыдущий
+_inline_searches = {}
+# Пауза перед поиском: пока пользователь печатает, запросы отменяют друг друга и до БД не доходят
+INLINE_DEBOUNCE = 0.3
+# Сколько секунд Telegram может сам отдавать наш ответ на тот же текст запроса
+INLINE_CACHE_TIME = 300
+
+
 async def inlinequery(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает инлайн-запросы для поиска товаров."""
     query_text = update.inline_query.query.strip()
+    user_id = update.inline_query.from_user.id
 
-    # Базовый SQL-запрос теперь напрямую выбирает cover_url
-    base_sql = """
-        SELECT
-            p.id, p.name, p.description, p.sub_category_id, p.brand_id,
-            p.cover_url,
-            c.name AS category,
-            sc.name AS subcategory,
-            b.name AS brand,
-            MIN(pv.price) AS min_price
-        FROM
-            products p
-        LEFT JOIN categories c ON p.category_id = c.id
-        LEFT JOIN sub_categories sc ON p.sub_category_id = sc.id
-        LEFT JOIN brands b ON p.brand_id = b.id
-        LEFT JOIN product_variants pv ON p.id = pv.product_id
-    """
+    previous = _inline_searches.get(user_id)
+    if previous is not None and not previous.done():
+        previous.cancel()
+    task = asyncio.current_task()
+    _inline_searches[user_id] = task
+    try:
+        # Ответ уже в кеше или это следующая страница — отвечаем сразу;
+        # иначе ждём, не напечатает ли пользователь дальше
+        offset = parse_offset(update.inline_query.offset)
+        if offset == 0 and cached_search(query_text) is None:
+            await asyncio.sleep(INLINE_DEBOUNCE)
+        await _answer_inline_query(update, query_text)
+    except asyncio.CancelledError:
+        # Пришёл более новый запрос этого пользователя — этот ответ уже никому не нужен
+        return
+    finally:
+        if _inline_searches.get(user_id) is task:
+            del _inline_searches[user_id]
 
-    if not query_text:
-        # Запрос для пустого поиска (показываем случайные товары)
-        # УДАЛЕНА СТРОЧКА 'AND p.is_active = 1'
-        query_sql = base_sql + " GROUP BY p.id ORDER BY RANDOM() LIMIT 10"
-        params = ()
-    else:
-        # Запрос для поиска по тексту
-        search_pattern = f"%{query_text}%"
-        query_sql = base_sql + """
-            WHERE
-                (p.name LIKE ? OR p.description LIKE ? OR c.name LIKE ? OR sc.name LIKE ? OR b.name LIKE ?)
-            GROUP BY p.id
-            ORDER BY RANDOM() LIMIT 10
-        """ # УДАЛЕНА СТРОЧКА 'AND p.is_active = 1'
-        params = (search_pattern,) * 5
-
-    products = await fetchall(query_sql, params)
+
+async def _answer_inline_query(update: Update, query_text):
+    # Поиск по тексту — полнотекстовый индекс, самые релевантные сверху;
+    # пустой запрос — подборка из памяти. Постранично, см. search.py
+    offset = parse_offset(update.inline_query.offset)
+    products, next_offset = await search_products(query_text, offset)
 
     results = []
     for p in products:
@@ -1459,7 +1417,10 @@ async def inlinequery(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         results.append(result)
 
-    await update.inline_query.answer(results, cache_time=1)
+    # Результаты одинаковы для всех пользователей — Telegram может кешировать их общими
+    await update.inline_query.answer(
+        results, cache_time=INLINE_CACHE_TIME, is_personal=False, next_offset=next_offset
+    )
 
 
 
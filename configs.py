@@ -19,4 +19,6 @@ if not BOT_TOKEN:
 ADMIN_IDS = [7955438947]           # Список id админов
 # Указываем путь к базе данных ВНУТРИ постоянного диска (volume)
 DB_FILE = "/data/shop.db" # Путь к базе данных, которая будет храниться на постоянном диске Fly.io
-ITEMS_PER_PAGE = 5
\ No newline at end of file
+ITEMS_PER_PAGE = 5
+# Дублировать отчёты в Google Таблицы (фоном, после отправки .xlsx). "0" — отключить.
+GSHEET_EXPORT = os.getenv("GSHEET_EXPORT", "1") == "1"
\ No newline at end of file
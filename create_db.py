@@ -4,6 +4,11 @@ import aiosqlite
 
 # --- ВАЖНО: Импортируем путь к БД из единого источника ---
 from configs import DB_FILE
+from schema import (
+    INDEXES, TRIGGERS, FTS_TABLE, FTS_TRIGGERS, REPORT_STATE_TABLE, SALES_TABLES,
+    PERSISTENCE_TABLE, CARTS_TABLE, RESERVATIONS_TABLES, product_variants_table,
+)
+from migrations import LATEST_VERSION
 
 async def main():
     """Асинхронно пересоздает структуру базы данных с использованием aiosqlite."""
@@ -57,6 +62,11 @@ async def main():
             sub_category_id INTEGER,
             brand_id INTEGER,
             cover_url TEXT,
+            -- Сводные колонки, их поддерживают триггеры из schema.py
+            min_price REAL,
+            total_quantity INTEGER NOT NULL DEFAULT 0,
+            first_file_id TEXT,
+            first_is_video INTEGER NOT NULL DEFAULT 0,
             FOREIGN KEY (category_id) REFERENCES categories (id),
             FOREIGN KEY (sub_category_id) REFERENCES sub_categories (id),
             FOREIGN KEY (brand_id) REFERENCES brands (id)
@@ -83,21 +93,7 @@ async def main():
         print("Таблицы 'sizes' и 'colors' созданы.")
 
         # --- 2. Таблица с вариантами товаров ---
-        await db.execute('''
-        CREATE TABLE product_variants (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER NOT NULL,
-            size_id INTEGER,
-            color_id INTEGER,
-            price REAL NOT NULL,
-            quantity INTEGER NOT NULL DEFAULT 0,
-            photo_id TEXT,
-            photo_url TEXT,
-            FOREIGN KEY (product_id) REFERENCES products (id) ON DELETE CASCADE,
-            FOREIGN KEY (size_id) REFERENCES sizes (id),
-            FOREIGN KEY (color_id) REFERENCES colors (id)
-        )
-        ''')
+        await db.execute(product_variants_table())
         print("Таблица 'product_variants' создана.")
 
         # --- 3. Таблица с медиафайлами ---
@@ -131,6 +127,62 @@ async def main():
         ''')
         print("Таблица 'orders' создана.")
 
+        # --- 5. Состав заказов (вместо разбора JSON из orders.cart) ---
+        await db.execute('''
+        CREATE TABLE order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            variant_id INTEGER,
+            name TEXT NOT NULL,
+            brand TEXT,
+            price REAL NOT NULL,
+            quantity INTEGER NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders (id) ON DELETE CASCADE
+        )
+        ''')
+        print("Таблица 'order_items' создана.")
+
+        # --- 6. Индексы для горячих запросов (общий набор из schema.py) ---
+        for _, sql in INDEXES:
+            await db.execute(sql)
+        print("Индексы горячих запросов созданы.")
+
+        # --- 7. Триггеры, поддерживающие сводные колонки products ---
+        for _, sql in TRIGGERS:
+            await db.execute(sql)
+        print("Триггеры сводных колонок созданы.")
+
+        # --- 8. Полнотекстовый индекс для инлайн-поиска ---
+        await db.execute(FTS_TABLE)
+        for _, sql in FTS_TRIGGERS:
+            await db.execute(sql)
+        print("Таблица 'products_fts' и её триггеры созданы.")
+
+        # --- 9. Отметки выгрузок отчётов ---
+        await db.execute(REPORT_STATE_TABLE)
+        print("Таблица 'report_state' создана.")
+
+        # --- 10. Свёртка продаж по дням ---
+        for sql in SALES_TABLES:
+            await db.execute(sql)
+        print("Таблицы 'sales_daily' и 'sales_daily_totals' созданы.")
+
+        # --- 11. Состояние бота (user_data, диалоги) ---
+        await db.execute(PERSISTENCE_TABLE)
+        print("Таблица 'bot_persistence' создана.")
+
+        # --- 12. Корзины покупателей ---
+        await db.execute(CARTS_TABLE)
+        print("Таблица 'carts' создана.")
+
+        # --- 13. Резервы остатков за неоплаченными заказами ---
+        for sql in RESERVATIONS_TABLES:
+            await db.execute(sql)
+        print("Таблица 'reservations' создана.")
+
+        # Новая база уже содержит все миграции из migrations.py
+        await db.execute(f"PRAGMA user_version = {LATEST_VERSION}")
+
         await db.commit()
         print(f"\n✅ База данных '{DB_FILE}' успешно пересоздана с полной структурой!")
 
@@ -1,25 +1,328 @@
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+
 import aiosqlite
 from configs import DB_FILE
+from schema import sales_rollup_sql
+
+# Сколько соединений держим открытыми для чтения (каталог, корзина, история)
+READER_POOL_SIZE = 4
+# Сколько запросов из очереди записи максимум коммитим одной транзакцией
+WRITE_BATCH_SIZE = 64
+
+# Настройки SQLite для каждого соединения.
+# WAL позволяет читателям не ждать писателя, synchronous=NORMAL в режиме WAL
+# делает fsync только на чекпойнтах, busy_timeout вместо мгновенного "database is locked".
+PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",      # ~16 МБ страничного кеша
+    "PRAGMA mmap_size = 134217728",    # 128 МБ файла БД читаем через mmap
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Пул читателей и отдельное соединение для записи.
+# Создаются один раз в init_db() при старте бота и закрываются в close_db().
+_readers = None
+_reader_conns = []
+_writer = None
+_writer_lock = asyncio.Lock()
+# Все одиночные записи идут через очередь в одну фоновую задачу-писателя
+_write_queue = None
+_writer_task = None
+
+
+async def _connect(**kwargs):
+    conn = await aiosqlite.connect(DB_FILE, **kwargs)
+    conn.row_factory = aiosqlite.Row
+    for pragma in PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+
+async def init_db():
+    """Открывает пул соединений и запускает писателя. Вызывается вместе с Application.initialize()."""
+    global _readers, _writer, _write_queue, _writer_task
+    if _writer is not None:
+        return
+    # isolation_level=None — транзакциями писателя управляем сами (BEGIN IMMEDIATE / COMMIT)
+    _writer = await _connect(isolation_level=None)
+    async with _writer.execute("PRAGMA journal_mode = WAL") as cursor:
+        mode = (await cursor.fetchone())[0]
+    if mode != "wal":
+        logging.warning(f"БД: не удалось включить WAL, текущий режим журнала: {mode}")
+
+    _readers = asyncio.Queue()
+    for _ in range(READER_POOL_SIZE):
+        conn = await _connect()
+        await conn.execute("PRAGMA query_only = 1")
+        _reader_conns.append(conn)
+        _readers.put_nowait(conn)
+
+    _write_queue = asyncio.Queue()
+    _writer_task = asyncio.create_task(_writer_loop())
+    logging.info(f"БД: открыто {READER_POOL_SIZE} соединений на чтение и 1 на запись ({DB_FILE}, journal_mode={mode})")
+
+
+async def close_db():
+    """Дописывает очередь, закрывает все соединения пула. Вызывается при остановке бота."""
+    global _readers, _writer, _write_queue, _writer_task
+    if _writer is None:
+        return
+    _write_queue.put_nowait(None)  # сигнал писателю: дописать всё и завершиться
+    await _writer_task
+    _writer_task = None
+    _write_queue = None
+    async with _writer_lock:
+        await _writer.close()
+        _writer = None
+    for conn in _reader_conns:
+        await conn.close()
+    _reader_conns.clear()
+    _readers = None
+    logging.info("БД: соединения закрыты.")
+
+
+@asynccontextmanager
+async def _reader():
+    # Если пул не открыт (скрипты миграций, ручной запуск) — работаем по-старому,
+    # через разовое соединение.
+    if _readers is None:
+        async with aiosqlite.connect(DB_FILE) as conn:
+            conn.row_factory = aiosqlite.Row
+            yield conn
+        return
+    conn = await _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put_nowait(conn)
+
+
+async def _writer_loop():
+    """Фоновая задача: забирает накопившиеся записи из очереди и коммитит их пачкой."""
+    while True:
+        job = await _write_queue.get()
+        if job is None:
+            return
+        batch = [job]
+        stop = False
+        while len(batch) < WRITE_BATCH_SIZE and not _write_queue.empty():
+            job = _write_queue.get_nowait()
+            if job is None:
+                stop = True
+                break
+            batch.append(job)
+        async with _writer_lock:
+            await _commit_batch(batch)
+        if stop:
+            return
+
+
+async def _commit_batch(batch):
+    """Выполняет пачку запросов в одной транзакции (один fsync на всю пачку).
+
+    Каждый запрос обёрнут в SAVEPOINT, поэтому ошибка в одном из них
+    откатывает только его, а не соседей по пачке.
+    """
+    results = []
+    try:
+        await _writer.execute("BEGIN IMMEDIATE")
+        for kind, query, params, _ in batch:
+            await _writer.execute("SAVEPOINT stmt")
+            try:
+                if kind == "many":
+                    await _writer.executemany(query, params)
+                    results.append((None, None))
+                else:
+                    cursor = await _writer.execute(query, params)
+                    results.append((cursor.lastrowid, None))
+                await _writer.execute("RELEASE stmt")
+            except Exception as e:
+                await _writer.execute("ROLLBACK TO stmt")
+                await _writer.execute("RELEASE stmt")
+                results.append((None, e))
+        await _writer.execute("COMMIT")
+    except Exception as e:
+        logging.exception("БД: не удалось закоммитить пачку записей")
+        try:
+            await _writer.execute("ROLLBACK")
+        except Exception:
+            pass
+        results = [(None, e)] * len(batch)
+
+    for (_, _, _, future), (result, error) in zip(batch, results):
+        if future.done():  # вызывающий уже ушёл (отмена)
+            continue
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+async def _enqueue_write(kind, query, params):
+    future = asyncio.get_running_loop().create_future()
+    _write_queue.put_nowait((kind, query, params, future))
+    return await future
+
+
+class Transaction:
+    """Запросы внутри одной транзакции (см. transaction())."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def execute(self, query, params=None):
+        cursor = await self._conn.execute(query, params or ())
+        return cursor.lastrowid
+
+    async def executemany(self, query, seq_of_params):
+        await self._conn.executemany(query, seq_of_params)
+
+    async def fetchall(self, query, params=None):
+        async with self._conn.execute(query, params or ()) as cursor:
+            return await cursor.fetchall()
+
+    async def fetchone(self, query, params=None):
+        async with self._conn.execute(query, params or ()) as cursor:
+            return await cursor.fetchone()
+
+
+@asynccontextmanager
+async def transaction():
+    """Несколько запросов на одном соединении с одним COMMIT.
+
+        async with transaction() as tx:
+            await tx.execute(...)
+            await tx.execute(...)
+
+    При любом исключении внутри блока всё откатывается.
+    Внутри блока пишите только через tx: обычный execute() ждёт в очереди
+    того же писателя и до конца транзакции не выполнится.
+    """
+    if _writer is None:
+        async with aiosqlite.connect(DB_FILE, isolation_level=None) as conn:
+            conn.row_factory = aiosqlite.Row
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield Transaction(conn)
+            except BaseException:
+                await conn.execute("ROLLBACK")
+                raise
+            await conn.execute("COMMIT")
+        return
+
+    async with _writer_lock:
+        await _writer.execute("BEGIN IMMEDIATE")
+        try:
+            yield Transaction(_writer)
+        except BaseException:
+            await _writer.execute("ROLLBACK")
+            raise
+        await _writer.execute("COMMIT")
+
+
+async def move_stock(tx, items, direction):
+    """Движение склада для целой корзины одним UPDATE ... FROM.
+
+    items — {variant_id: количество}, direction: -1 списать, +1 вернуть на склад.
+    Списание условное и только из свободного остатка (WHERE quantity - reserved >= qty):
+    товар, зарезервированный за другими заказами, не трогаем, и остаток не уходит в минус
+    даже при одновременных подтверждениях. Резерв своего заказа снимите до списания
+    (reservations.confirm_order). Возврат на склад (+1) не ограничен.
+    Возвращает {variant_id: новый остаток} для обновлённых вариантов; чего в нём нет из
+    items — не исполнено (не хватило остатка или вариант удалён), см. unfulfilled().
+    """
+    if not items:
+        return {}
+    movement = json.dumps([{"id": int(v), "qty": int(q)} for v, q in items.items()])
+    rows = await tx.fetchall("""
+        UPDATE product_variants
+        SET quantity = product_variants.quantity + ?1 * m.qty
+        FROM (
+            SELECT json_extract(value, '$.id') AS variant_id, json_extract(value, '$.qty') AS qty
+            FROM json_each(?2)
+        ) AS m
+        WHERE product_variants.id = m.variant_id
+          AND (?1 > 0 OR product_variants.quantity - product_variants.reserved >= m.qty)
+        RETURNING product_variants.id, product_variants.quantity
+    """, (direction, movement))
+    return {row[0]: row[1] for row in rows}
+
+
+def unfulfilled(items, moved):
+    """Позиции заказа (см. fetch_order_items), которые move_stock() не списал."""
+    return [item for item in items if item['variant_id'] is None or item['variant_id'] not in moved]
+
+
+async def move_sales(tx, order_id, direction):
+    """Учитывает заказ в свёртке продаж (sales_daily, см. schema.py).
+
+    direction: +1 — заказ списан со склада (продажа), -1 — списание отменено.
+    Вызывается в той же транзакции, что и move_stock() со сменой deducted_from_stock.
+    """
+    for sql in sales_rollup_sql("o.id = ?2"):
+        await tx.execute(sql, (direction, order_id))
+
+
+def stock_items(items):
+    """Позиции заказа (см. fetch_order_items) -> {variant_id: количество} для move_stock()."""
+    return {item['variant_id']: item['quantity'] for item in items if item['variant_id'] is not None}
+
+
+ORDER_ITEMS_SQL = """
+    SELECT variant_id, name, brand, price, quantity
+    FROM order_items
+    WHERE order_id = ?
+    ORDER BY id
+"""
+
+
+async def fetch_order_items(order_id):
+    """Состав заказа из таблицы order_items: список dict с variant_id, name, brand, price, quantity."""
+    rows = await fetchall(ORDER_ITEMS_SQL, (order_id,))
+    return [dict(row) for row in rows]
+
 
 async def fetchall(query, params=None):
-    async with aiosqlite.connect(DB_FILE) as db:
-        db.row_factory = aiosqlite.Row
+    async with _reader() as db:
         async with db.execute(query, params or ()) as cursor:
             return await cursor.fetchall()
 
 async def fetchone(query, params=None):
-    async with aiosqlite.connect(DB_FILE) as db:
-        db.row_factory = aiosqlite.Row
+    async with _reader() as db:
         async with db.execute(query, params or ()) as cursor:
             return await cursor.fetchone()
 
+async def iterate(query, params=None, chunk_size=500):
+    """Построчно отдаёт результат запроса, не загружая его в память целиком.
+
+        async for row in iterate("SELECT ..."):
+            ...
+    """
+    async with _reader() as db:
+        async with db.execute(query, params or ()) as cursor:
+            while True:
+                rows = await cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row
+
 async def execute(query, params=None):
+    if _write_queue is not None:
+        return await _enqueue_write("one", query, params or ())
     async with aiosqlite.connect(DB_FILE) as db:
         cursor = await db.execute(query, params or ())
         await db.commit()
         return cursor.lastrowid
 
 async def executemany(query, seq_of_params):
+    if _write_queue is not None:
+        await _enqueue_write("many", query, list(seq_of_params))
+        return
     async with aiosqlite.connect(DB_FILE) as db:
         await db.executemany(query, seq_of_params)
-        await db.commit()
\ No newline at end of file
+        await db.commit()
@@ -3,7 +3,7 @@ import os
 import asyncio
 from telegram import Update
 from telegram.ext import (
-    Application, ContextTypes, PicklePersistence, CommandHandler, 
+    Application, ContextTypes, CommandHandler, 
     CallbackQueryHandler, InlineQueryHandler, MessageHandler, filters, 
     ConversationHandler
 )
@@ -17,11 +17,17 @@ from starlette.routing import Route
 
 # --- Сіздің импорттарыңыз ---
 from configs import BOT_TOKEN
+from db import init_db, close_db
+from migrations import run_migrations
+from persistence import SQLitePersistence
+from search import start_featured_refresh, stop_featured_refresh
+from reservations import start_reservation_sweeper, stop_reservation_sweeper
+from report_jobs import shutdown_reports
 from admin_handlers_newupdate import (
      add_product_conv , finish_media,
      report_handler, admin_decision_handler, cancel_dialog, cat_manage_handler,
     subcat_manage_handler, subcat_rename_conv, brand_manage_handler, brand_rename_conv,
-    orders_report_handler, orders_report_period_handler, admin_conv, 
+    orders_report_handler, orders_report_period_handler, orders_report_range_handler, report_jobs_handler, admin_conv, 
     get_name, get_new_category_name, get_new_subcategory_name, get_new_brand_name, get_description,
     get_new_size_name, get_new_color_name, get_variant_price, get_variant_quantity,
      update_order_status_admin, order_history_handler, order_filter_handler,
@@ -53,7 +59,8 @@ async def debug_all_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def main() -> None:
     """Ботты баптап, іске қосатын негізгі асинхронды функция."""
     
-    persistence = PicklePersistence(filepath="bot_data.pkl")
+    # user_data, chat_data и диалоги хранятся построчно в БД (см. persistence.py)
+    persistence = SQLitePersistence()
     application = (
         Application.builder().token(BOT_TOKEN).persistence(persistence).build()
     )
@@ -97,6 +104,8 @@ async def main() -> None:
     application.add_handler(brand_manage_handler, group=1)
     application.add_handler(orders_report_handler, group=1)
     application.add_handler(orders_report_period_handler, group=1)
+    application.add_handler(orders_report_range_handler, group=1)
+    application.add_handler(report_jobs_handler, group=1)
     application.add_handler(CallbackQueryHandler(update_order_status_admin, pattern=r"^status_(preparing|shipped|delivered)_\d+$"), group=1)
     application.add_handler(CallbackQueryHandler(order_history_handler, pattern="^order_history$"), group=1)
     application.add_handler(CallbackQueryHandler(order_filter_handler, pattern="^order_filter_"), group=1)
@@ -131,7 +140,8 @@ async def main() -> None:
     application.add_handler(payment_confirmation_handler, group=1)
     application.add_handler(checkout_handler, group=1)
     application.add_handler(CallbackQueryHandler(color_photo_pagination, pattern=r"^colorphoto_\d+_\d+_\d+$"), group=1)
-    application.add_handler(InlineQueryHandler(inlinequery), group=1)
+    # block=False: поиски разных пользователей идут параллельно, и новый запрос может отменить старый
+    application.add_handler(InlineQueryHandler(inlinequery, block=False), group=1)
     application.add_handler(CallbackQueryHandler(cancel_by_client, pattern=r"^cancel_by_client_\d+$"), group=1)
     application.add_handler(CallbackQueryHandler(confirm_cancel, pattern=r"^confirm_cancel_\d+$"), group=1)
     application.add_handler(CallbackQueryHandler(back_to_payment, pattern=r"^back_to_payment_\d+$"), group=1)
@@ -170,15 +180,29 @@ async def main() -> None:
     )
 
     # --- Бәрін бірге іске қосу ---
-    await application.initialize()
-    await application.bot.set_webhook(url=f"https://new-project-test.fly.dev{webhook_path}")
-    await asyncio.sleep(2)  # ← дам немного времени, чтобы всё успело подняться
-    
-    # Боттың "конвейерін" және веб-серверді қатар іске қосамыз
-    async with application:
-        await application.start()
-        await web_server.serve()
-        await application.stop()
+    # Пул БД открываем до application.initialize(): оттуда persistence читает user_data
+    await init_db()  # пул соединений с БД живёт столько же, сколько приложение
+    try:
+        await run_migrations()  # новые миграции схемы применяются до приёма апдейтов
+        # Выход из async with — application.shutdown(): persistence сбрасывается в базу,
+        # поэтому пул закрываем только после него, в finally
+        async with application:
+            start_featured_refresh()  # подборка для пустого инлайн-запроса, обновляется в фоне
+            start_reservation_sweeper()  # снимает просроченные резервы неоплаченных заказов
+            await application.bot.set_webhook(url=f"https://new-project-test.fly.dev{webhook_path}")
+            await asyncio.sleep(2)  # ← дам немного времени, чтобы всё успело подняться
+
+            # Боттың "конвейерін" және веб-серверді қатар іске қосамыз
+            await application.start()
+            try:
+                await web_server.serve()
+            finally:
+                await shutdown_reports()  # до stop(): HTTP-клиент бота ещё открыт
+                await application.stop()
+    finally:
+        await stop_reservation_sweeper()
+        await stop_featured_refresh()
+        await close_db()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,296 @@
+import asyncio
+import logging
+
+from db import init_db, close_db, transaction, fetchone
+from schema import (
+    SUMMARY_COLUMNS, TRIGGERS, summary_triggers, summary_update_sql, FTS_TABLE, FTS_TRIGGERS, fts_insert_sql,
+    REPORT_STATE_TABLE, SALES_TABLES, sales_rollup_sql, PERSISTENCE_TABLE,
+    CARTS_TABLE, RESERVATIONS_TABLES, product_variants_table, INDEXES,
+)
+
+# Миграции схемы БД. Номер последней применённой хранится в PRAGMA user_version.
+# run_migrations() вызывается при старте бота и применяет все новые миграции по порядку,
+# каждую — в своей транзакции. Таблицы целиком, как правило, не копируются: только
+# добавление индексов/колонок и дозаполнение данных небольшими порциями
+# (исключение — миграция 10: CHECK в SQLite добавляется только пересборкой таблицы).
+#
+# Чтобы добавить миграцию: напишите функцию up(tx) (и при необходимости backfill())
+# и допишите её в конец MIGRATIONS со следующим номером. Уже выпущенные миграции не меняйте.
+
+# Сколько строк обрабатываем за одну транзакцию при дозаполнении
+BACKFILL_CHUNK = 500
+
+
+async def add_index(tx, name):
+    """CREATE INDEX IF NOT EXISTS по определению индекса name из schema.INDEXES."""
+    await tx.execute(dict(INDEXES)[name])
+
+
+async def add_column(tx, table, column, definition):
+    """ALTER TABLE ... ADD COLUMN, если такой колонки ещё нет. Возвращает True, если колонка добавлена."""
+    rows = await tx.fetchall(f"PRAGMA table_info({table})")
+    if any(row['name'] == column for row in rows):
+        return False
+    await tx.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+
+async def backfill(table, sql, chunk_size=BACKFILL_CHUNK):
+    """Выполняет sql порциями по диапазонам id таблицы table, каждую порцию — своей транзакцией.
+
+    sql получает два параметра — границы диапазона (от, до) включительно, например:
+        UPDATE products SET x = ... WHERE id BETWEEN ? AND ? AND x IS NULL
+    Запрос должен быть повторяемым: если бот упадёт посреди дозаполнения,
+    при следующем старте миграция пройдёт его заново.
+    """
+    row = await fetchone(f"SELECT MIN(id), MAX(id) FROM {table}")
+    low, high = row[0], row[1]
+    if low is None:
+        return
+    chunks = 0
+    for start in range(low, high + 1, chunk_size):
+        async with transaction() as tx:
+            await tx.execute(sql, (start, start + chunk_size - 1))
+        chunks += 1
+        await asyncio.sleep(0)  # отдаём управление остальным задачам между порциями
+    logging.info(f"Миграции: {table} дозаполнена за {chunks} транзакций")
+
+
+# --- 1. Состав заказов в отдельной таблице order_items ---
+
+async def _order_items_up(tx):
+    await tx.execute('''
+    CREATE TABLE IF NOT EXISTS order_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER NOT NULL,
+        variant_id INTEGER,
+        name TEXT NOT NULL,
+        brand TEXT,
+        price REAL NOT NULL,
+        quantity INTEGER NOT NULL,
+        FOREIGN KEY (order_id) REFERENCES orders (id) ON DELETE CASCADE
+    )
+    ''')
+    await add_index(tx, "idx_order_items_order")
+
+
+async def _order_items_backfill():
+    # Переносим состав из JSON-колонки orders.cart для заказов, у которых его ещё нет.
+    # Заказы с битым JSON пропускаются (json_valid).
+    await backfill("orders", '''
+        INSERT INTO order_items (order_id, variant_id, name, brand, price, quantity)
+        SELECT o.id, CAST(j.key AS INTEGER),
+               json_extract(j.value, '$.name'), json_extract(j.value, '$.brand'),
+               json_extract(j.value, '$.price'), json_extract(j.value, '$.quantity')
+        FROM orders o, json_each(o.cart) j
+        WHERE o.id BETWEEN ? AND ?
+          AND json_valid(o.cart)
+          AND NOT EXISTS (SELECT 1 FROM order_items oi WHERE oi.order_id = o.id)
+    ''')
+
+
+# --- 2. Индексы горячих запросов (первый набор из schema.INDEXES) ---
+
+async def _indexes_up(tx):
+    for name in ("idx_products_subcat_brand", "idx_variants_product_stock", "idx_variants_product_color",
+                 "idx_media_variant_order", "idx_sub_categories_category", "idx_orders_user"):
+        await add_index(tx, name)
+    await tx.execute("ANALYZE")
+
+
+# --- 3. Сводные колонки products (цена, наличие, обложка) и триггеры для них ---
+
+async def _product_summary_up(tx):
+    for column, definition in SUMMARY_COLUMNS:
+        await add_column(tx, "products", column, definition)
+    # Колонки reserved в этой версии ещё нет: наличие считается по quantity (см. миграцию 9)
+    for name, sql in summary_triggers("quantity", "product_id, price, quantity"):
+        await tx.execute(f"DROP TRIGGER IF EXISTS {name}")
+        await tx.execute(sql)
+    # Индексы слайдера по сводным колонкам: слайдер читает только products
+    await add_index(tx, "idx_products_listing")
+    await add_index(tx, "idx_products_listing_brand")
+
+
+async def _product_summary_backfill():
+    await backfill("products", summary_update_sql("id BETWEEN ? AND ?", "quantity"))
+    async with transaction() as tx:
+        await tx.execute("ANALYZE")
+
+
+# --- 4. Полнотекстовый индекс products_fts для инлайн-поиска ---
+
+async def _products_fts_up(tx):
+    await tx.execute(FTS_TABLE)
+    for name, sql in FTS_TRIGGERS:
+        await tx.execute(f"DROP TRIGGER IF EXISTS {name}")
+        await tx.execute(sql)
+
+
+async def _products_fts_backfill():
+    # ?1/?2 — границы диапазона; уже проиндексированные товары пропускаем
+    await backfill("products", fts_insert_sql(
+        "p.id BETWEEN ?1 AND ?2 AND p.id NOT IN (SELECT rowid FROM products_fts WHERE rowid BETWEEN ?1 AND ?2)"
+    ))
+
+
+# --- 5. Отчёты по заказам: индекс по created_at и отметки выгрузок ---
+
+async def _orders_reports_up(tx):
+    await tx.execute(REPORT_STATE_TABLE)
+    await add_index(tx, "idx_orders_created")
+
+
+async def _orders_created_at_backfill():
+    # Старые заказы сохраняли created_at в ISO-формате ('2025-07-12T23:18:55.123+00:00').
+    # Приводим к формату CURRENT_TIMESTAMP, чтобы отчёты сравнивали строки без datetime().
+    await backfill("orders", """
+        UPDATE orders SET created_at = datetime(created_at)
+        WHERE id BETWEEN ? AND ? AND created_at <> datetime(created_at)
+    """)
+
+
+# --- 6. Свёртка продаж по дням sales_daily ---
+
+async def _sales_daily_up(tx):
+    for sql in SALES_TABLES:
+        await tx.execute(sql)
+    # Заполняем одной транзакцией вместе с созданием таблиц (и номером версии):
+    # суммы не повторяемы порциями — повторный проход посчитал бы продажи дважды.
+    # Свёртка маленькая, а заказов несравнимо меньше, чем товаров.
+    await tx.execute("DELETE FROM sales_daily")
+    await tx.execute("DELETE FROM sales_daily_totals")
+    for sql in sales_rollup_sql("o.deducted_from_stock = 1"):
+        await tx.execute(sql, (1,))
+
+
+# --- 7. Состояние бота в таблице вместо bot_data.pkl ---
+# Сами данные переносит из файла SQLitePersistence при первом запуске (см. persistence.py).
+
+async def _persistence_up(tx):
+    await tx.execute(PERSISTENCE_TABLE)
+
+
+# --- 8. Корзины в таблице carts вместо user_data ---
+# Старые корзины из user_data переносятся при первом обращении (carts.adopt_legacy_cart).
+
+async def _carts_up(tx):
+    await tx.execute(CARTS_TABLE)
+
+
+# --- 9. Резервы остатков за неоплаченными заказами ---
+# Наличие в сводных колонках products теперь считается по свободному остатку
+# quantity - reserved: триггеры пересоздаются. Пока резервов нет, сводка совпадает
+# со старой, так что пересчитывать её не нужно.
+
+async def _reservations_up(tx):
+    await add_column(tx, "product_variants", "reserved", "INTEGER NOT NULL DEFAULT 0")
+    for sql in RESERVATIONS_TABLES:
+        await tx.execute(sql)
+    for name, sql in TRIGGERS:
+        await tx.execute(f"DROP TRIGGER IF EXISTS {name}")
+        await tx.execute(sql)
+
+
+
+# --- 10. CHECK (quantity >= 0) на product_variants ---
+# ALTER TABLE не добавляет ограничения, поэтому таблица пересобирается по процедуре из
+# документации SQLite: новая таблица -> копия строк -> DROP старой -> RENAME новой ->
+# индексы и триггеры заново. Внешние ключи в соединениях бота не включены
+# (PRAGMA foreign_keys по умолчанию OFF), так что DROP не задевает product_media.
+# Вариантов немного (тысячи строк), копия укладывается в одну транзакцию.
+
+async def _variants_check_up(tx):
+    # Отрицательные остатки (перепродажи до условного списания) обнуляем, пока триггеры
+    # сводных колонок ещё на месте — они пересчитают наличие товаров
+    negative = await tx.fetchall("SELECT id, quantity FROM product_variants WHERE quantity < 0")
+    if negative:
+        logging.warning(f"Миграции: обнуляю отрицательные остатки вариантов {[tuple(row) for row in negative]}")
+        await tx.execute("UPDATE product_variants SET quantity = 0 WHERE quantity < 0")
+    await tx.execute("UPDATE product_variants SET reserved = 0 WHERE reserved < 0")
+
+    indexes = await tx.fetchall("""
+        SELECT sql FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = 'product_variants' AND sql IS NOT NULL
+    """)
+    sequence = await tx.fetchone("SELECT seq FROM sqlite_sequence WHERE name = 'product_variants'")
+    for name, _ in TRIGGERS:
+        await tx.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+    await tx.execute(product_variants_table("product_variants_new"))
+    new_columns = {row['name'] for row in await tx.fetchall("PRAGMA table_info(product_variants_new)")}
+    columns = ", ".join(
+        row['name'] for row in await tx.fetchall("PRAGMA table_info(product_variants)")
+        if row['name'] in new_columns
+    )
+    await tx.execute(f"INSERT INTO product_variants_new ({columns}) SELECT {columns} FROM product_variants")
+    await tx.execute("DROP TABLE product_variants")
+    await tx.execute("ALTER TABLE product_variants_new RENAME TO product_variants")
+    if sequence is not None:
+        # Номера удалённых вариантов не выдаём повторно (order_items ссылаются на них)
+        await tx.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'product_variants'", (sequence[0],))
+
+    for row in indexes:
+        await tx.execute(row['sql'])
+    for name, sql in TRIGGERS:
+        await tx.execute(sql)
+
+
+# (номер, описание, up(tx), backfill() или None)
+MIGRATIONS = (
+    (1, "состав заказов в order_items", _order_items_up, _order_items_backfill),
+    (2, "индексы горячих запросов", _indexes_up, None),
+    (3, "сводные колонки products", _product_summary_up, _product_summary_backfill),
+    (4, "полнотекстовый поиск products_fts", _products_fts_up, _products_fts_backfill),
+    (5, "отчёты по заказам за любой период", _orders_reports_up, _orders_created_at_backfill),
+    (6, "свёртка продаж по дням", _sales_daily_up, None),
+    (7, "состояние бота в bot_persistence", _persistence_up, None),
+    (8, "корзины в таблице carts", _carts_up, None),
+    (9, "резервы остатков за заказами", _reservations_up, None),
+    (10, "CHECK (quantity >= 0) на product_variants", _variants_check_up, None),
+)
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def _set_version(tx, version):
+    # PRAGMA не принимает параметры; version — всегда int из MIGRATIONS
+    await tx.execute(f"PRAGMA user_version = {int(version)}")
+
+
+async def run_migrations():
+    """Применяет все миграции с номером больше PRAGMA user_version."""
+    async with transaction() as tx:
+        current = (await tx.fetchone("PRAGMA user_version"))[0]
+
+    for version, title, up, backfill_step in MIGRATIONS:
+        if version <= current:
+            continue
+        logging.info(f"Миграции: применяю №{version} — {title}")
+        async with transaction() as tx:
+            await up(tx)
+            if backfill_step is None:
+                await _set_version(tx, version)
+        if backfill_step is not None:
+            # Схема уже закоммичена, данные дозаполняем порциями,
+            # номер версии ставим только когда дозаполнение завершено.
+            await backfill_step()
+            async with transaction() as tx:
+                await _set_version(tx, version)
+        current = version
+
+    logging.info(f"Миграции: схема БД на версии {current}")
+    return current
+
+
+async def main():
+    await init_db()
+    try:
+        version = await run_migrations()
+    finally:
+        await close_db()
+    print(f"✅ Схема базы данных на версии {version}.")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,247 @@
+import asyncio
+import hashlib
+import json
+import logging
+import pickle
+import time
+from pathlib import Path
+
+from telegram.ext import BasePersistence, PicklePersistence
+
+from db import fetchall, fetchone, transaction
+
+# Хранилище состояния бота (user_data, chat_data, bot_data, callback_data и состояния
+# диалогов с persistent=True) в таблице bot_persistence основной базы.
+# Раньше всё лежало в bot_data.pkl (PicklePersistence), и при каждом сохранении файл
+# переписывался целиком. Здесь каждая запись — отдельная строка (kind, key), и пишутся
+# только строки, данные которых действительно изменились: стоимость сохранения
+# зависит от числа активных пользователей, а не от их общего числа.
+#
+# Записи не пишутся сразу: изменённые строки копятся в буфере (последняя версия каждой
+# строки) и раз в FLUSH_INTERVAL секунд уходят в БД одной транзакцией. Если в буфере
+# набралось MAX_PENDING строк, он сбрасывается немедленно. При остановке бота
+# Application.shutdown() вызывает flush(), и буфер дописывается до закрытия БД.
+#
+# Значения хранятся в pickle, как и в PicklePersistence.
+# При первом запуске, если таблица пуста, данные переносятся из старого bot_data.pkl.
+
+LEGACY_PICKLE_FILE = "bot_data.pkl"
+
+UPDATE_INTERVAL = 10    # секунд: как часто PTB отдаёт нам данные пользователей, с которыми было общение
+FLUSH_INTERVAL = 30     # секунд: как часто буфер пишется в БД
+MAX_PENDING = 1000      # строк в буфере, после которых он пишется сразу
+
+_BOT_KEY = ""  # ключ строк bot_data и callback_data
+
+
+def _dump(value):
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _digest(blob):
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+def _conversation_kind(name):
+    return f"conversation:{name}"
+
+
+class SQLitePersistence(BasePersistence):
+    """BasePersistence поверх таблицы bot_persistence (см. schema.py).
+
+    Пул соединений (db.init_db) должен быть открыт до Application.initialize()
+    и закрыт после Application.shutdown().
+    """
+
+    def __init__(self, store_data=None, update_interval=UPDATE_INTERVAL, flush_interval=FLUSH_INTERVAL,
+                 max_pending=MAX_PENDING, legacy_file=LEGACY_PICKLE_FILE):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.legacy_file = Path(legacy_file) if legacy_file else None
+        # (kind, key) -> хеш последних принятых данных: неизменённые строки не переписываем
+        self._digests = {}
+        # (kind, key) -> pickle для записи или None для удаления
+        self._pending = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._imported = False
+        # Счётчики: сколько сбросов, сколько строк за сброс и сколько времени он занял
+        self.stats = {
+            "flushes": 0,
+            "rows_written": 0,
+            "rows_skipped": 0,      # update_* без изменений — в буфер не попали
+            "last_flush_rows": 0,
+            "last_flush_seconds": 0.0,
+            "max_flush_rows": 0,
+            "max_flush_seconds": 0.0,
+            "total_flush_seconds": 0.0,
+        }
+
+    # --- Чтение при старте ---
+
+    async def _load(self, kind):
+        await self._import_legacy_file()
+        rows = await fetchall("SELECT key, data FROM bot_persistence WHERE kind = ?", (kind,))
+        result = {}
+        for row in rows:
+            self._digests[(kind, row['key'])] = _digest(row['data'])
+            result[row['key']] = pickle.loads(row['data'])
+        return result
+
+    async def get_user_data(self):
+        return {int(key): data for key, data in (await self._load("user")).items()}
+
+    async def get_chat_data(self):
+        return {int(key): data for key, data in (await self._load("chat")).items()}
+
+    async def get_bot_data(self):
+        return (await self._load("bot")).get(_BOT_KEY, {})
+
+    async def get_callback_data(self):
+        return (await self._load("callback")).get(_BOT_KEY)
+
+    async def get_conversations(self, name):
+        rows = await self._load(_conversation_kind(name))
+        return {tuple(json.loads(key)): state for key, state in rows.items()}
+
+    # --- Запись ---
+
+    async def _put(self, kind, key, value):
+        blob = _dump(value)
+        digest = _digest(blob)
+        if self._digests.get((kind, key)) == digest:
+            self.stats["rows_skipped"] += 1
+            return
+        self._digests[(kind, key)] = digest
+        await self._enqueue((kind, key), blob)
+
+    async def _delete(self, kind, key):
+        if self._digests.pop((kind, key), None) is None and (kind, key) not in self._pending:
+            return
+        await self._enqueue((kind, key), None)
+
+    async def _enqueue(self, row_key, blob):
+        self._pending[row_key] = blob
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if len(self._pending) >= self.max_pending:
+            await self._write_pending()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._write_pending()
+            except Exception:
+                logging.exception("Не удалось сохранить состояние бота, повторим при следующем сбросе")
+
+    async def _write_pending(self):
+        """Пишет буфер в БД одной транзакцией."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            started = time.perf_counter()
+            try:
+                async with transaction() as tx:
+                    upserts = [(kind, key, blob) for (kind, key), blob in batch.items() if blob is not None]
+                    deletes = [(kind, key) for (kind, key), blob in batch.items() if blob is None]
+                    if upserts:
+                        await tx.executemany("""
+                            INSERT INTO bot_persistence (kind, key, data) VALUES (?, ?, ?)
+                            ON CONFLICT (kind, key) DO UPDATE SET data = excluded.data
+                        """, upserts)
+                    if deletes:
+                        await tx.executemany("DELETE FROM bot_persistence WHERE kind = ? AND key = ?", deletes)
+            except BaseException:
+                # Не записалось — возвращаем в буфер всё, что с тех пор не изменилось ещё раз
+                for row_key, blob in batch.items():
+                    self._pending.setdefault(row_key, blob)
+                raise
+            elapsed = time.perf_counter() - started
+
+        stats = self.stats
+        stats["flushes"] += 1
+        stats["rows_written"] += len(batch)
+        stats["last_flush_rows"] = len(batch)
+        stats["last_flush_seconds"] = elapsed
+        stats["max_flush_rows"] = max(stats["max_flush_rows"], len(batch))
+        stats["max_flush_seconds"] = max(stats["max_flush_seconds"], elapsed)
+        stats["total_flush_seconds"] += elapsed
+        logging.debug(f"Состояние бота сохранено: {len(batch)} строк за {elapsed * 1000:.1f} мс")
+
+    async def update_user_data(self, user_id, data):
+        await self._put("user", str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._put("chat", str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        await self._put("bot", _BOT_KEY, data)
+
+    async def update_callback_data(self, data):
+        await self._put("callback", _BOT_KEY, data)
+
+    async def update_conversation(self, name, key, new_state):
+        kind, row_key = _conversation_kind(name), json.dumps(list(key))
+        if new_state is None:
+            await self._delete(kind, row_key)
+        else:
+            await self._put(kind, row_key, new_state)
+
+    async def drop_user_data(self, user_id):
+        await self._delete("user", str(user_id))
+
+    async def drop_chat_data(self, chat_id):
+        await self._delete("chat", str(chat_id))
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Останавливает фоновый сброс и дописывает буфер. PTB вызывает это при shutdown()."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self._write_pending()
+        logging.info(f"Состояние бота сохранено перед остановкой, счётчики: {self.stats}")
+
+    # --- Перенос из bot_data.pkl ---
+
+    async def _import_legacy_file(self):
+        if self._imported:
+            return
+        self._imported = True
+        if self.legacy_file is None or not self.legacy_file.exists():
+            return
+        if await fetchone("SELECT 1 FROM bot_persistence LIMIT 1"):
+            return
+
+        legacy = PicklePersistence(filepath=self.legacy_file)
+        legacy.set_bot(self.bot)
+        rows = [("user", str(k), _dump(v)) for k, v in (await legacy.get_user_data()).items()]
+        rows += [("chat", str(k), _dump(v)) for k, v in (await legacy.get_chat_data()).items()]
+        rows.append(("bot", _BOT_KEY, _dump(await legacy.get_bot_data())))
+        callback_data = await legacy.get_callback_data()
+        if callback_data is not None:
+            rows.append(("callback", _BOT_KEY, _dump(callback_data)))
+        for name, states in (legacy.conversations or {}).items():
+            rows += [
+                (_conversation_kind(name), json.dumps(list(key)), _dump(state))
+                for key, state in states.items()
+            ]
+
+        async with transaction() as tx:
+            await tx.executemany("INSERT OR IGNORE INTO bot_persistence (kind, key, data) VALUES (?, ?, ?)", rows)
+        logging.info(f"Состояние бота перенесено из {self.legacy_file}: {len(rows)} записей")
@@ -0,0 +1,243 @@
+import asyncio
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from configs import GSHEET_EXPORT
+from db import execute
+from bee import (
+    fetch_products_detailed, export_to_gsheet, GOOGLE_SHEET_URL,
+    prepare_orders_data_for_gsheet, iter_orders_sheet_rows, export_orders_to_gsheet,
+    export_to_excel_xlsxwriter, orders_period_start, last_order_id, get_report_mark,
+)
+
+# Фоновые отчёты для админа.
+# Функции bee.py синхронные (sqlite3, gspread, requests) и работают десятки секунд,
+# поэтому выполняются в пуле потоков, а не в цикле событий бота: клиенты
+# в это время продолжают пользоваться ботом. Когда отчёт готов, результат
+# (сообщения и файлы) отправляется в чат, из которого его заказали.
+#
+# .xlsx собирается локально (xlsxwriter) и отправляется сразу; выгрузка в Google Таблицы
+# (если включена GSHEET_EXPORT) идёт следом отдельной фоновой задачей и присылает ссылку.
+#
+# Отчёт по заказам "с прошлой выгрузки" берёт заказы с id больше отметки из report_state
+# и сдвигает отметку только после того, как файл отправлен: повторная ежедневная
+# выгрузка читает лишь новые заказы, а неотправленный отчёт не теряет их.
+
+REPORT_WORKERS = 2        # сколько отчётов может строиться одновременно
+KEEP_FINISHED_JOBS = 20   # сколько завершённых задач помним для /reports
+
+# Имя отметки в report_state для выгрузки заказов "с прошлого раза"
+INCREMENTAL_ORDERS_REPORT = "orders_incremental"
+
+STATUS_TITLES = {
+    "queued": "в очереди",
+    "running": "строится",
+    "done": "готов",
+    "failed": "ошибка",
+}
+
+_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+_job_ids = itertools.count(1)
+_jobs = {}
+
+
+class ReportJob:
+    def __init__(self, key, title, chat_id):
+        self.id = next(_job_ids)
+        self.key = key
+        self.title = title
+        self.chat_id = chat_id
+        self.status = "queued"
+        self.error = None
+        self.created_at = datetime.now()
+        self.finished_at = None
+        self.task = None
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+
+class ReportResult:
+    """Что отправить в чат: тексты сообщений и файлы (путь, имя файла, подпись).
+
+    followups — задачи (key, title, build, args), которые запускаются после отправки,
+    например выгрузка того же отчёта в Google Таблицы.
+    after_send — корутины (func, args), которые выполняются в цикле событий после
+    успешной отправки, например сохранение отметки выгрузки.
+    """
+
+    def __init__(self, messages=(), files=(), followups=(), after_send=()):
+        self.messages = list(messages)
+        self.files = list(files)
+        self.followups = list(followups)
+        self.after_send = list(after_send)
+
+
+def find_active_job(key):
+    for job in _jobs.values():
+        if job.key == key and job.active:
+            return job
+    return None
+
+
+def list_jobs():
+    """Задачи от новых к старым."""
+    return sorted(_jobs.values(), key=lambda job: job.id, reverse=True)
+
+
+def submit_report(bot, chat_id, key, title, build, *args):
+    """Ставит отчёт в очередь и сразу возвращает ReportJob.
+
+    build(*args) выполняется в пуле потоков и возвращает ReportResult.
+    Если такой же отчёт (key) уже строится, новый не запускается — возвращается None.
+    """
+    if find_active_job(key) is not None:
+        return None
+    job = ReportJob(key, title, chat_id)
+    _jobs[job.id] = job
+    job.task = asyncio.create_task(_run_job(bot, job, build, args))
+    _forget_old_jobs()
+    return job
+
+
+async def _run_job(bot, job, build, args):
+    loop = asyncio.get_running_loop()
+    try:
+        job.status = "running"
+        result = await loop.run_in_executor(_executor, build, *args)
+        for text in result.messages:
+            await bot.send_message(chat_id=job.chat_id, text=text)
+        for path, filename, caption in result.files:
+            with open(path, "rb") as f:
+                await bot.send_document(chat_id=job.chat_id, document=f, filename=filename, caption=caption)
+        for func, func_args in result.after_send:
+            await func(*func_args)
+        job.status = "done"
+        for key, title, followup, followup_args in result.followups:
+            submit_report(bot, job.chat_id, key, title, followup, *followup_args)
+    except asyncio.CancelledError:
+        job.status = "failed"
+        job.error = "остановлен"
+        raise
+    except Exception as e:
+        logging.exception(f"Отчёт #{job.id} ({job.title}) завершился с ошибкой")
+        job.status = "failed"
+        job.error = str(e)
+        try:
+            await bot.send_message(chat_id=job.chat_id, text=f"❌ {job.title}: не удалось построить отчёт ({e}).")
+        except Exception:
+            logging.exception("Не удалось сообщить админу об ошибке отчёта")
+    finally:
+        job.finished_at = datetime.now()
+
+
+def _forget_old_jobs():
+    finished = [job for job in list_jobs() if not job.active]
+    for job in finished[KEEP_FINISHED_JOBS:]:
+        del _jobs[job.id]
+
+
+async def shutdown_reports():
+    """Останавливает незавершённые отчёты. Вызывается при остановке бота, пока bot ещё открыт.
+
+    Отчёты из очереди не запускаются, а уже начатые дописываются до конца (файлы
+    не остаются оборванными), но в чат не отправляются.
+    """
+    tasks = [job.task for job in _jobs.values() if job.active and job.task]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # Поток xlsxwriter не прервать: ждём его вне цикла событий
+    await asyncio.to_thread(_executor.shutdown, wait=True, cancel_futures=True)
+
+
+# --- Построение отчётов (выполняется в потоке пула) ---
+
+def build_products_report():
+    data = fetch_products_detailed()
+    xlsx_file = export_to_excel_xlsxwriter(data, filename="otchet_po_tovaram.xlsx", constant_memory=True)
+
+    followups = []
+    if GSHEET_EXPORT:
+        followups.append(("products_gsheet", "Отчёт по товарам в Google Таблицах", build_products_gsheet, (data,)))
+    return ReportResult(
+        files=[(xlsx_file, "products_report.xlsx", "Отчёт по товарам (.xlsx)")],
+        followups=followups,
+    )
+
+
+def build_products_gsheet(data):
+    export_to_gsheet(data)
+    return ReportResult([f"Ссылка на Google Таблицу:\n{GOOGLE_SHEET_URL}"])
+
+
+def build_orders_report(period, period_title):
+    return _build_orders_file(period, period_title, {"date_from": orders_period_start(period)})
+
+
+def build_orders_range_report(date_from, date_to):
+    """Заказы за дни с date_from по date_to включительно (date)."""
+    name = f"{date_from:%Y%m%d}_{date_to:%Y%m%d}"
+    title = f"{date_from:%d.%m.%Y} — {date_to:%d.%m.%Y}"
+    return _build_orders_file(name, title, {"date_from": date_from, "date_to": date_to + timedelta(days=1)})
+
+
+def build_orders_incremental_report():
+    """Заказы, появившиеся после прошлой такой выгрузки."""
+    after_id = get_report_mark(INCREMENTAL_ORDERS_REPORT)
+    # Верхняя граница фиксируется заранее: заказы, пришедшие во время выгрузки, попадут в следующую
+    up_to_id = last_order_id()
+    if up_to_id <= after_id:
+        return ReportResult(["❗️Новых заказов с прошлой выгрузки нет."])
+    result = _build_orders_file(
+        f"new_{after_id + 1}_{up_to_id}", "с прошлой выгрузки",
+        {"after_id": after_id, "up_to_id": up_to_id},
+    )
+    result.after_send.append((save_report_mark, (INCREMENTAL_ORDERS_REPORT, up_to_id)))
+    return result
+
+
+async def save_report_mark(name, order_id):
+    """Сдвигает отметку выгрузки name вперёд до order_id (назад — никогда)."""
+    await execute("""
+        INSERT INTO report_state (name, last_order_id, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(name) DO UPDATE SET
+            last_order_id = excluded.last_order_id, updated_at = excluded.updated_at
+        WHERE excluded.last_order_id > report_state.last_order_id
+    """, (name, order_id))
+
+
+def _build_orders_file(name, title, order_range):
+    """.xlsx по заказам order_range (аргументы bee.iter_orders_range); name — для имён файлов."""
+    # Заказы идут из курсора прямо в .xlsx (constant_memory): в памяти не держим весь период
+    rows = iter_orders_sheet_rows(**order_range)
+    header = next(rows)
+    first = next(rows, None)
+    if first is None:
+        return ReportResult(["❗️Заказов за выбранный период не найдено."])
+
+    xlsx_file = export_to_excel_xlsxwriter(
+        itertools.chain([header, first], rows),
+        filename=f"orders_report_{name}.xlsx", constant_memory=True,
+    )
+
+    followups = []
+    if GSHEET_EXPORT:
+        followups.append((
+            f"orders_{name}_gsheet", f"Отчёт по заказам ({title}) в Google Таблицах",
+            build_orders_gsheet, (name, order_range),
+        ))
+    return ReportResult(
+        files=[(xlsx_file, f"orders_report_{name}.xlsx", f"📄 Отчёт по заказам ({title})")],
+        followups=followups,
+    )
+
+
+def build_orders_gsheet(name, order_range):
+    # Google Таблицам нужен весь список сразу — читаем его отдельно, уже в фоновой задаче
+    data = prepare_orders_data_for_gsheet(**order_range)
+    _, sheet_url = export_orders_to_gsheet(data, f"заказы_{name}")
+    return ReportResult([f"🔗 Ссылка на Google Таблицу:\n{sheet_url}"])
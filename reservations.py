@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+
+from db import transaction, move_stock, move_sales, stock_items, unfulfilled
+from catalog_cache import invalidate_listings
+
+# Резервы остатков за заказами, которые ещё не подтвердил админ.
+# При оформлении заказа (client_handlers.ask_phone) товар резервируется в той же транзакции,
+# что и создание заказа: product_variants.reserved растёт, и свободный остаток
+# (quantity - reserved) уменьшается. Если свободного остатка не хватает хотя бы по одной
+# позиции, транзакция откатывается целиком и заказ не создаётся.
+# Резерв по каждой позиции — строка reservations (order_id, variant_id, qty, expires_at).
+#
+# Дальше резерв:
+#   - при подтверждении заказа снимается в той же транзакции, что и списание со склада
+#     (confirm_order); если на складе не хватает, не меняется ничего;
+#   - при отклонении или отмене заказа просто снимается (cancel_order);
+#   - при нажатии "Оплатил" продлевается на RESERVATION_PAID_TTL (ждём проверки оплаты);
+#   - если срок вышел, его снимает фоновая задача (раз в SWEEP_INTERVAL секунд).
+#     Сам заказ при этом не отменяется: админ всё ещё может его подтвердить,
+#     но товар за ним больше не держится.
+#
+# Слайдер, карточка товара и корзина показывают свободный остаток, поэтому после любой
+# смены резервов нужно вызвать invalidate_listings() (функции ниже делают это сами,
+# кроме тех, что работают внутри чужой транзакции, — их вызывающий код).
+
+RESERVATION_TTL = 3600          # секунд: сколько держим товар за неоплаченным заказом
+RESERVATION_PAID_TTL = 86400    # секунд: сколько держим после "Оплатил", пока админ проверяет
+SWEEP_INTERVAL = 60             # секунд между проходами фоновой задачи
+
+# Статусы заказа, из которых его можно подтвердить
+CONFIRMABLE_STATUSES = ("pending_payment", "pending_verification")
+# Статусы завершённого заказа: его уже нельзя ни отклонить, ни отменить
+FINISHED_STATUSES = ("delivered", "cancelled_by_client", "rejected")
+
+# Снятие резерва заказа и просроченных резервов: удалённые строки возвращаются в свободный остаток
+RELEASE_SQL = "DELETE FROM reservations WHERE order_id = ? RETURNING variant_id, qty"
+SWEEP_SQL = "DELETE FROM reservations WHERE expires_at <= datetime('now') RETURNING order_id, variant_id, qty"
+
+_sweeper_task = None
+
+
+def _ttl_modifier(ttl):
+    # Модификатор datetime() для срока резерва: '+3600 seconds'
+    return f"{int(ttl):+d} seconds"
+
+
+class OutOfStock(Exception):
+    """Свободного остатка не хватает. variant_ids — позиции, которые не удалось зарезервировать."""
+
+    def __init__(self, variant_ids):
+        super().__init__(f"Не хватает остатка по вариантам {sorted(variant_ids)}")
+        self.variant_ids = set(variant_ids)
+
+
+async def reserve_stock(tx, order_id, items, ttl=RESERVATION_TTL):
+    """Резервирует items ({variant_id: количество}) за заказом в транзакции tx.
+
+    Все позиции — одним UPDATE ... FROM с проверкой свободного остатка в WHERE.
+    Если хоть одна позиция не прошла, бросает OutOfStock: транзакция откатится вместе с заказом.
+    """
+    if not items:
+        return
+    movement = json.dumps([{"id": int(v), "qty": int(q)} for v, q in items.items()])
+    rows = await tx.fetchall("""
+        UPDATE product_variants
+        SET reserved = product_variants.reserved + m.qty
+        FROM (
+            SELECT json_extract(value, '$.id') AS variant_id, json_extract(value, '$.qty') AS qty
+            FROM json_each(?)
+        ) AS m
+        WHERE product_variants.id = m.variant_id
+          AND product_variants.quantity - product_variants.reserved >= m.qty
+        RETURNING product_variants.id
+    """, (movement,))
+    missing = {int(v) for v in items} - {row[0] for row in rows}
+    if missing:
+        raise OutOfStock(missing)
+    await tx.execute("""
+        INSERT INTO reservations (order_id, variant_id, qty, expires_at)
+        SELECT ?, json_extract(value, '$.id'), json_extract(value, '$.qty'), datetime('now', ?)
+        FROM json_each(?)
+    """, (order_id, _ttl_modifier(ttl), movement))
+
+
+async def release_reservation(tx, order_id):
+    """Снимает резерв заказа в транзакции tx (подтверждение, отклонение, отмена).
+
+    Повторный вызов ничего не делает: строки резерва удаляются.
+    """
+    rows = await tx.fetchall(RELEASE_SQL, (order_id,))
+    await _unreserve(tx, rows)
+
+
+async def _unreserve(tx, rows):
+    # rows — удалённые строки reservations (variant_id, qty, ...): возвращаем их в свободный остаток
+    if not rows:
+        return
+    movement = json.dumps([{"id": row['variant_id'], "qty": row['qty']} for row in rows])
+    await tx.execute("""
+        UPDATE product_variants
+        SET reserved = MAX(product_variants.reserved - m.qty, 0)
+        FROM (
+            SELECT json_extract(value, '$.id') AS variant_id, SUM(json_extract(value, '$.qty')) AS qty
+            FROM json_each(?)
+            GROUP BY variant_id
+        ) AS m
+        WHERE product_variants.id = m.variant_id
+    """, (movement,))
+
+
+async def confirm_order(order_id, items):
+    """Подтверждение заказа: резерв превращается в списание одной транзакцией.
+
+    Снятие резерва, условное списание (db.move_stock), продажа в свёртку и статус 'confirmed'.
+    items — состав заказа (db.fetch_order_items). Возвращает:
+      None — заказа нет или он уже не ждёт подтверждения (подтверждён, отклонён, отменён);
+      []   — заказ подтверждён;
+      позиции, которых не хватило на складе, — транзакция откачена, заказ и резерв как были.
+    """
+    short = []
+    try:
+        async with transaction() as tx:
+            # 💥 Статус и флаг списания читаем внутри транзакции: заказ, который успели
+            # отменить или подтвердить, не списываем второй раз
+            row = await tx.fetchone("SELECT status, deducted_from_stock FROM orders WHERE id = ?", (order_id,))
+            if row is None or row["status"] not in CONFIRMABLE_STATUSES:
+                return None
+            await release_reservation(tx, order_id)
+            if str(row["deducted_from_stock"]) != "1":
+                moved = await move_stock(tx, stock_items(items), -1)
+                short = unfulfilled(items, moved)
+                if short:
+                    raise OutOfStock([item['variant_id'] for item in short if item['variant_id'] is not None])
+                await tx.execute("UPDATE orders SET deducted_from_stock = 1 WHERE id = ?", (order_id,))
+                await move_sales(tx, order_id, +1)
+            await tx.execute("UPDATE orders SET status = ? WHERE id = ?", ('confirmed', order_id))
+    except OutOfStock:
+        return short
+    invalidate_listings()
+    return []
+
+
+async def cancel_order(order_id, items, status):
+    """Отклонение (status='rejected') или отмена клиентом ('cancelled_by_client') одной транзакцией.
+
+    Списанный товар возвращается на склад и вычитается из свёртки продаж, резерв снимается,
+    заказ получает status. items — состав заказа (db.fetch_order_items).
+    Возвращает False, если заказа нет или он уже завершён (FINISHED_STATUSES): тогда не меняется ничего.
+    """
+    async with transaction() as tx:
+        # Как в confirm_order: статус читаем внутри транзакции, чтобы дважды не вернуть товар на склад
+        row = await tx.fetchone("SELECT status, deducted_from_stock FROM orders WHERE id = ?", (order_id,))
+        if row is None or row["status"] in FINISHED_STATUSES:
+            return False
+        if str(row["deducted_from_stock"]) == "1":
+            await move_stock(tx, stock_items(items), +1)
+            await tx.execute("UPDATE orders SET deducted_from_stock = 0 WHERE id = ?", (order_id,))
+            await move_sales(tx, order_id, -1)
+        await release_reservation(tx, order_id)
+        await tx.execute("UPDATE orders SET status = ? WHERE id = ?", (status, order_id))
+    invalidate_listings()
+    return True
+
+
+async def extend_reservation(order_id, ttl=RESERVATION_PAID_TTL):
+    """Продлевает резерв заказа на ttl секунд от текущего момента (если он ещё есть)."""
+    async with transaction() as tx:
+        await tx.execute(
+            "UPDATE reservations SET expires_at = datetime('now', ?) WHERE order_id = ?",
+            (_ttl_modifier(ttl), order_id),
+        )
+
+
+async def sweep_expired():
+    """Снимает просроченные резервы. Возвращает количество заказов, чьи резервы сняты."""
+    # Выборка и удаление — одним DELETE: резерв, продлённый в эту же секунду, не снимется
+    async with transaction() as tx:
+        rows = await tx.fetchall(SWEEP_SQL)
+        await _unreserve(tx, rows)
+    if not rows:
+        return 0
+    invalidate_listings()
+    order_ids = sorted({row['order_id'] for row in rows})
+    logging.info(f"Сняты просроченные резервы заказов: {order_ids}")
+    return len(order_ids)
+
+
+async def _sweeper_loop():
+    while True:
+        try:
+            await sweep_expired()
+        except Exception:
+            logging.exception("Не удалось снять просроченные резервы")
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+
+def start_reservation_sweeper():
+    """Запускает фоновое снятие просроченных резервов. Вызывается при старте бота после init_db()."""
+    global _sweeper_task
+    if _sweeper_task is None:
+        _sweeper_task = asyncio.create_task(_sweeper_loop())
+
+
+async def stop_reservation_sweeper():
+    """Останавливает фоновое снятие резервов. Вызывается перед close_db()."""
+    global _sweeper_task
+    if _sweeper_task is None:
+        return
+    _sweeper_task.cancel()
+    try:
+        await _sweeper_task
+    except asyncio.CancelledError:
+        pass
+    _sweeper_task = None
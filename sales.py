@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta, timezone
+
+from db import fetchall
+
+# Отчёты о продажах по свёртке sales_daily / sales_daily_totals (см. schema.py).
+# Свёртку поддерживает db.move_sales() при подтверждении, отклонении и отмене заказов,
+# поэтому отчёт за неделю читает несколько сотен строк свёртки, а не заказы и их состав.
+# Продажа — заказ, списанный со склада: подтверждённый и дальше (готовится, отправлен, доставлен).
+
+# Итоги по дням с первого дня периода
+DAILY_SALES_SQL = """
+    SELECT day, orders, revenue FROM sales_daily_totals WHERE day >= ? ORDER BY day
+"""
+# Самые продаваемые товары: первый день периода, сколько товаров
+TOP_SELLERS_SQL = """
+    SELECT t.product_id, COALESCE(p.name, 'Удалённый товар') AS name, t.sold, t.revenue
+    FROM (
+        SELECT s.product_id, SUM(s.qty) AS sold, SUM(s.revenue) AS revenue
+        FROM sales_daily s
+        WHERE s.day >= ?
+        GROUP BY s.product_id
+        HAVING sold > 0
+        ORDER BY sold DESC
+        LIMIT ?
+    ) t
+    LEFT JOIN products p ON p.id = t.product_id
+    ORDER BY t.sold DESC
+"""
+
+
+def _first_day(days):
+    # Дни в свёртке — даты created_at заказов, то есть UTC
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+async def daily_sales(days=7):
+    """Выручка по дням за последние days дней: список dict с day, orders, revenue (по возрастанию дня)."""
+    rows = await fetchall(DAILY_SALES_SQL, (_first_day(days),))
+    return [dict(row) for row in rows if row['orders'] > 0]
+
+
+async def top_sellers(days=7, limit=5):
+    """Самые продаваемые товары за последние days дней: список dict с product_id, name, sold, revenue."""
+    rows = await fetchall(TOP_SELLERS_SQL, (_first_day(days), limit))
+    return [dict(row) for row in rows]
@@ -0,0 +1,296 @@
+# Единый список индексов для горячих запросов бота.
+# create_db.py создаёт весь набор на новой базе; на рабочую базу индексы
+# попадают миграциями из migrations.py — add_index() берёт определение отсюда по имени.
+# Новый индекс — добавьте сюда и миграцию с add_index(); убранный — миграцию
+# с DROP INDEX IF EXISTS. Определение уже выпущенного индекса не меняйте: заведите новое имя.
+# Сами запросы проверяет check_query_plans.py.
+
+INDEXES = (
+    # Состав заказа
+    ("idx_order_items_order",
+     "CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)"),
+    # Слайдер: товары раздела (и бренда) -> варианты в наличии -> минимальная цена
+    ("idx_products_subcat_brand",
+     "CREATE INDEX IF NOT EXISTS idx_products_subcat_brand ON products (sub_category_id, brand_id)"),
+    ("idx_variants_product_stock",
+     "CREATE INDEX IF NOT EXISTS idx_variants_product_stock ON product_variants (product_id, quantity, price)"),
+    # Карточка товара: цвета и размеры варианта
+    ("idx_variants_product_color",
+     "CREATE INDEX IF NOT EXISTS idx_variants_product_color ON product_variants (product_id, color_id, size_id)"),
+    # Фото/видео варианта по порядку
+    ("idx_media_variant_order",
+     'CREATE INDEX IF NOT EXISTS idx_media_variant_order ON product_media (variant_id, "order")'),
+    # Разделы категории
+    ("idx_sub_categories_category",
+     "CREATE INDEX IF NOT EXISTS idx_sub_categories_category ON sub_categories (category_id)"),
+    # История заказов клиента, новые сверху
+    ("idx_orders_user",
+     "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, id)"),
+    # Слайдер по сводным колонкам products: только товары в наличии, в порядке (цена, id)
+    ("idx_products_listing",
+     "CREATE INDEX IF NOT EXISTS idx_products_listing ON products (sub_category_id, min_price, id) WHERE total_quantity > 0"),
+    ("idx_products_listing_brand",
+     "CREATE INDEX IF NOT EXISTS idx_products_listing_brand ON products (sub_category_id, brand_id, min_price, id) WHERE total_quantity > 0"),
+    # Отчёт по заказам за период: created_at сравнивается без datetime(), см. bee._db_time
+    ("idx_orders_created",
+     "CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at, id)"),
+)
+
+# Свёртка продаж по дням для отчётов (см. db.move_sales, sales.py).
+# Продажа — заказ, списанный со склада (deducted_from_stock = 1): строки добавляются
+# при подтверждении и вычитаются при отклонении/отмене, в той же транзакции.
+# День — дата создания заказа (UTC), чтобы отмена попадала в тот же день, что и продажа.
+# variant_id = 0 — позиции, вариант которых удалён ещё до заказа.
+SALES_TABLES = (
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        day TEXT NOT NULL,
+        variant_id INTEGER NOT NULL,
+        product_id INTEGER,
+        qty INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, variant_id)
+    )""",
+    # Итоги дня: число заказов по позициям не сложить, считаем его отдельно
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily_totals (
+        day TEXT PRIMARY KEY,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue REAL NOT NULL DEFAULT 0
+    )""",
+)
+
+
+def sales_rollup_sql(where):
+    """Два INSERT ... ON CONFLICT, прибавляющие к свёртке заказы, отобранные условием where (алиас o).
+
+    Первый параметр каждого запроса — знак (+1 продажа, -1 отмена продажи).
+    """
+    return (f"""
+        INSERT INTO sales_daily (day, variant_id, product_id, qty, revenue)
+        SELECT date(o.created_at), COALESCE(oi.variant_id, 0), MAX(pv.product_id),
+               ?1 * SUM(oi.quantity), ?1 * SUM(oi.price * oi.quantity)
+        FROM orders o
+        JOIN order_items oi ON oi.order_id = o.id
+        LEFT JOIN product_variants pv ON pv.id = oi.variant_id
+        WHERE {where}
+        GROUP BY 1, 2
+        ON CONFLICT (day, variant_id) DO UPDATE SET
+            product_id = COALESCE(product_id, excluded.product_id),
+            qty = qty + excluded.qty,
+            revenue = revenue + excluded.revenue
+    """, f"""
+        INSERT INTO sales_daily_totals (day, orders, revenue)
+        SELECT date(o.created_at), ?1 * COUNT(*), ?1 * SUM(o.total_price)
+        FROM orders o
+        WHERE {where}
+        GROUP BY 1
+        ON CONFLICT (day) DO UPDATE SET
+            orders = orders + excluded.orders,
+            revenue = revenue + excluded.revenue
+    """)
+
+
+# Состояние бота (user_data, chat_data, диалоги) — см. persistence.py.
+# kind: "user", "chat", "bot", "callback" или "conversation:<имя диалога>"; data — pickle.
+PERSISTENCE_TABLE = """
+    CREATE TABLE IF NOT EXISTS bot_persistence (
+        kind TEXT NOT NULL,
+        key TEXT NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (kind, key)
+    ) WITHOUT ROWID"""
+
+# Корзины покупателей (см. carts.py): только id варианта и количество,
+# название и цена берутся из каталога при показе корзины.
+CARTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS carts (
+        user_id INTEGER NOT NULL,
+        variant_id INTEGER NOT NULL,
+        qty INTEGER NOT NULL,
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, variant_id)
+    ) WITHOUT ROWID"""
+
+# Отметки инкрементальных выгрузок: id последнего выгруженного заказа
+REPORT_STATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS report_state (
+        name TEXT PRIMARY KEY,
+        last_order_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )"""
+
+# Сводные колонки products, которые поддерживают триггеры ниже:
+#   min_price      — минимальная цена среди вариантов в наличии (если в наличии нет — среди всех)
+#   total_quantity — сколько штук товара в наличии (сумма положительных остатков)
+#   first_file_id, first_is_video — обложка: первое медиа первого варианта, у которого оно есть
+# "В наличии" — свободный остаток: quantity минус reserved (держится за неоплаченными заказами,
+# см. reservations.py).
+SUMMARY_COLUMNS = (
+    ("min_price", "REAL"),
+    ("total_quantity", "INTEGER NOT NULL DEFAULT 0"),
+    ("first_file_id", "TEXT"),
+    ("first_is_video", "INTEGER NOT NULL DEFAULT 0"),
+)
+
+# Свободный остаток варианта и колонки product_variants, от которых он зависит.
+# Миграция 3 (до колонки reserved) передаёт свои значения явно.
+AVAILABLE = "quantity - reserved"
+AVAILABLE_COLUMNS = "product_id, price, quantity, reserved"
+
+
+def summary_update_sql(where, available=AVAILABLE):
+    """UPDATE, пересчитывающий сводные колонки товаров, отобранных условием where."""
+    return f"""
+        UPDATE products SET
+            min_price = COALESCE(
+                (SELECT MIN(price) FROM product_variants WHERE product_id = products.id AND {available} > 0),
+                (SELECT MIN(price) FROM product_variants WHERE product_id = products.id)
+            ),
+            total_quantity = (
+                SELECT COALESCE(SUM({available}), 0) FROM product_variants
+                WHERE product_id = products.id AND {available} > 0
+            ),
+            first_file_id = (
+                SELECT pm.file_id FROM product_media pm
+                JOIN product_variants pv ON pm.variant_id = pv.id
+                WHERE pv.product_id = products.id
+                ORDER BY pv.id, pm."order", pm.id LIMIT 1
+            ),
+            first_is_video = COALESCE((
+                SELECT pm.is_video FROM product_media pm
+                JOIN product_variants pv ON pm.variant_id = pv.id
+                WHERE pv.product_id = products.id
+                ORDER BY pv.id, pm."order", pm.id LIMIT 1
+            ), 0)
+        WHERE {where}"""
+
+
+def _media_product(variant_expr):
+    return f"id = (SELECT product_id FROM product_variants WHERE id = {variant_expr})"
+
+
+def summary_triggers(available=AVAILABLE, variant_columns=AVAILABLE_COLUMNS):
+    """Триггеры, поддерживающие сводные колонки при любых изменениях вариантов и медиа."""
+    return (
+        ("trg_variants_summary_insert", f"""
+            CREATE TRIGGER trg_variants_summary_insert AFTER INSERT ON product_variants
+            BEGIN {summary_update_sql("id = NEW.product_id", available)}; END"""),
+        ("trg_variants_summary_delete", f"""
+            CREATE TRIGGER trg_variants_summary_delete AFTER DELETE ON product_variants
+            BEGIN {summary_update_sql("id = OLD.product_id", available)}; END"""),
+        ("trg_variants_summary_update", f"""
+            CREATE TRIGGER trg_variants_summary_update AFTER UPDATE OF {variant_columns} ON product_variants
+            BEGIN
+                {summary_update_sql("id = NEW.product_id", available)};
+                {summary_update_sql("id = OLD.product_id", available)} AND OLD.product_id <> NEW.product_id;
+            END"""),
+        ("trg_media_summary_insert", f"""
+            CREATE TRIGGER trg_media_summary_insert AFTER INSERT ON product_media
+            BEGIN {summary_update_sql(_media_product("NEW.variant_id"), available)}; END"""),
+        ("trg_media_summary_delete", f"""
+            CREATE TRIGGER trg_media_summary_delete AFTER DELETE ON product_media
+            BEGIN {summary_update_sql(_media_product("OLD.variant_id"), available)}; END"""),
+        ("trg_media_summary_update", f"""
+            CREATE TRIGGER trg_media_summary_update AFTER UPDATE OF variant_id, file_id, is_video, "order" ON product_media
+            BEGIN
+                {summary_update_sql(_media_product("NEW.variant_id"), available)};
+                {summary_update_sql(_media_product("OLD.variant_id"), available)};
+            END"""),
+    )
+
+
+TRIGGERS = summary_triggers()
+
+# Варианты товаров. Остаток и резерв не бывают отрицательными: CHECK — последняя
+# страховка от перепродажи под условными списаниями (db.move_stock) и резервами.
+# create_db.py создаёт таблицу отсюда; миграция 10 пересобирает по ней старые базы
+# (name — имя временной копии).
+def product_variants_table(name="product_variants"):
+    return f"""
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            size_id INTEGER,
+            color_id INTEGER,
+            price REAL NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 0 CHECK (quantity >= 0),
+            reserved INTEGER NOT NULL DEFAULT 0 CHECK (reserved >= 0),
+            photo_id TEXT,
+            photo_url TEXT,
+            FOREIGN KEY (product_id) REFERENCES products (id) ON DELETE CASCADE,
+            FOREIGN KEY (size_id) REFERENCES sizes (id),
+            FOREIGN KEY (color_id) REFERENCES colors (id)
+        )"""
+
+
+# Резервы остатков за неоплаченными заказами (см. reservations.py).
+# Сумма qty по варианту хранится в product_variants.reserved.
+RESERVATIONS_TABLES = (
+    """CREATE TABLE IF NOT EXISTS reservations (
+        order_id INTEGER NOT NULL,
+        variant_id INTEGER NOT NULL,
+        qty INTEGER NOT NULL,
+        expires_at TIMESTAMP NOT NULL,
+        PRIMARY KEY (order_id, variant_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_reservations_expires ON reservations (expires_at)",
+)
+
+# Полнотекстовый индекс для инлайн-поиска: rowid = products.id,
+# названия категории, раздела и бренда хранятся прямо в строке индекса.
+# prefix — готовые индексы префиксов, чтобы поиск по началу слова ("крос*") был быстрым.
+FTS_TABLE = """
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, description, category, subcategory, brand,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )"""
+
+
+def fts_insert_sql(where):
+    """INSERT в products_fts для товаров, отобранных условием where (алиас p)."""
+    return f"""
+        INSERT INTO products_fts (rowid, name, description, category, subcategory, brand)
+        SELECT p.id, p.name, COALESCE(p.description, ''),
+               COALESCE((SELECT name FROM categories WHERE id = p.category_id), ''),
+               COALESCE((SELECT name FROM sub_categories WHERE id = p.sub_category_id), ''),
+               COALESCE((SELECT name FROM brands WHERE id = p.brand_id), '')
+        FROM products p
+        WHERE {where}"""
+
+
+# Триггеры, поддерживающие products_fts при изменениях товаров и справочников
+FTS_TRIGGERS = (
+    ("trg_products_fts_insert", f"""
+        CREATE TRIGGER trg_products_fts_insert AFTER INSERT ON products
+        BEGIN {fts_insert_sql("p.id = NEW.id")}; END"""),
+    ("trg_products_fts_delete", """
+        CREATE TRIGGER trg_products_fts_delete AFTER DELETE ON products
+        BEGIN DELETE FROM products_fts WHERE rowid = OLD.id; END"""),
+    ("trg_products_fts_update", f"""
+        CREATE TRIGGER trg_products_fts_update
+        AFTER UPDATE OF name, description, category_id, sub_category_id, brand_id ON products
+        BEGIN
+            DELETE FROM products_fts WHERE rowid = OLD.id;
+            {fts_insert_sql("p.id = NEW.id")};
+        END"""),
+    ("trg_categories_fts_rename", """
+        CREATE TRIGGER trg_categories_fts_rename AFTER UPDATE OF name ON categories
+        BEGIN
+            UPDATE products_fts SET category = NEW.name
+            WHERE rowid IN (SELECT id FROM products WHERE category_id = NEW.id);
+        END"""),
+    ("trg_sub_categories_fts_rename", """
+        CREATE TRIGGER trg_sub_categories_fts_rename AFTER UPDATE OF name ON sub_categories
+        BEGIN
+            UPDATE products_fts SET subcategory = NEW.name
+            WHERE rowid IN (SELECT id FROM products WHERE sub_category_id = NEW.id);
+        END"""),
+    ("trg_brands_fts_rename", """
+        CREATE TRIGGER trg_brands_fts_rename AFTER UPDATE OF name ON brands
+        BEGIN
+            UPDATE products_fts SET brand = NEW.name
+            WHERE rowid IN (SELECT id FROM products WHERE brand_id = NEW.id);
+        END"""),
+)
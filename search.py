@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import random
+import re
+import time
+from collections import OrderedDict
+
+from db import fetchall, iterate
+
+# Инлайн-поиск товаров по полнотекстовому индексу products_fts (см. schema.py).
+# Каждое слово запроса ищется по началу ("крос" найдёт "кроссовки"), все слова обязательны.
+# Порядок — по релевантности bm25: совпадение в названии весит больше, чем в описании;
+# при равной релевантности — по id, чтобы страницы не перемешивались.
+# Пустой запрос — подборка случайных товаров в наличии, которую фоновая задача
+# пересобирает раз в FEATURED_REFRESH секунд; отдаётся из памяти без SQL.
+# После изменений каталога (invalidate_search) подборка пересобирается раньше срока,
+# через FEATURED_DEBOUNCE секунд, чтобы удалённые и распроданные товары в ней не задерживались.
+#
+# Результаты отдаются страницами: Telegram присылает offset из нашего next_offset,
+# когда пользователь долистывает до конца списка. offset — номер строки в выдаче.
+
+# Сколько результатов на странице (Telegram принимает не больше 50)
+SEARCH_PAGE_SIZE = 20
+# Веса колонок products_fts для bm25: name, description, category, subcategory, brand
+BM25_WEIGHTS = (10.0, 1.0, 2.0, 3.0, 5.0)
+
+# Страница результатов: MATCH, LIMIT, OFFSET
+SEARCH_SQL = f"""
+    SELECT
+        p.id, p.name, p.description, p.sub_category_id, p.brand_id,
+        p.cover_url, p.min_price, f.brand
+    FROM products_fts f
+    JOIN products p ON p.id = f.rowid
+    WHERE products_fts MATCH ?
+    ORDER BY bm25(products_fts, {", ".join(str(w) for w in BM25_WEIGHTS)}), p.id
+    LIMIT ? OFFSET ?
+"""
+
+# Кеш результатов в памяти: Telegram шлёт инлайн-запрос почти на каждую букву,
+# а разные пользователи набирают одни и те же слова.
+SEARCH_CACHE_SIZE = 512   # сколько разных запросов помним (вытесняется самый давний)
+SEARCH_CACHE_TTL = 60     # секунд; после этого результат перечитывается из БД
+
+# (нормализованный запрос, offset) -> (момент устаревания, (строки, next_offset))
+_cache = OrderedDict()
+
+# Подборка для пустого запроса
+FEATURED_SIZE = 50        # сколько товаров в подборке
+FEATURED_REFRESH = 600    # секунд между пересборками
+FEATURED_DEBOUNCE = 5     # секунд: изменения каталога за это время — одна пересборка
+_featured = []
+_featured_task = None
+_featured_stale = asyncio.Event()
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def fts_query(text):
+    """Текст пользователя -> выражение MATCH для FTS5 или None, если искать нечего.
+
+    Берём только буквы и цифры: кавычки, звёздочки и операторы FTS5 из ввода
+    не должны ломать запрос.
+    """
+    words = _WORD_RE.findall(text.lower())
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def _cache_get(key):
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    expires, page = entry
+    if expires < time.monotonic():
+        del _cache[key]
+        return None
+    _cache.move_to_end(key)
+    return page
+
+
+def _cache_put(key, page):
+    _cache[key] = (time.monotonic() + SEARCH_CACHE_TTL, page)
+    _cache.move_to_end(key)
+    while len(_cache) > SEARCH_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def parse_offset(offset):
+    """offset из инлайн-запроса Telegram (строка, для первой страницы пустая) -> int."""
+    return int(offset) if offset and offset.isdigit() else 0
+
+
+def cached_search(text, offset=0):
+    """Страница из памяти без обращения к БД или None, если её там нет."""
+    match = fts_query(text)
+    if match is None:
+        return _featured_page(offset)
+    return _cache_get((match, offset))
+
+
+def _featured_page(offset):
+    rows = _featured[offset:offset + SEARCH_PAGE_SIZE]
+    next_offset = str(offset + SEARCH_PAGE_SIZE) if offset + SEARCH_PAGE_SIZE < len(_featured) else ""
+    return rows, next_offset
+
+
+async def search_products(text, offset=0):
+    """Страница результатов поиска: (строки, next_offset).
+
+    next_offset — строка для InlineQuery.answer(): offset следующей страницы
+    или "" если это последняя страница.
+    """
+    match = fts_query(text)
+
+    # Пустой запрос — подборка из памяти, без БД и без кеша
+    if match is None:
+        return _featured_page(offset)
+
+    key = (match, offset)
+    page = _cache_get(key)
+    if page is not None:
+        return page
+
+    # Берём на одну строку больше, чтобы понять, есть ли следующая страница
+    rows = await fetchall(SEARCH_SQL, (match, SEARCH_PAGE_SIZE + 1, offset))
+
+    has_more = len(rows) > SEARCH_PAGE_SIZE
+    page = (rows[:SEARCH_PAGE_SIZE], str(offset + SEARCH_PAGE_SIZE) if has_more else "")
+    _cache_put(key, page)
+    return page
+
+
+def invalidate_search():
+    """Сбрасывает кеш результатов поиска и просит пересобрать подборку (после изменений каталога)."""
+    _cache.clear()
+    _featured_stale.set()
+
+
+async def refresh_featured():
+    """Пересобирает подборку: равномерная случайная выборка товаров в наличии.
+
+    Товары читаются потоком (reservoir sampling), в памяти держим только саму подборку.
+    """
+    global _featured
+    sample = []
+    seen = 0
+    async for row in iterate("""
+        SELECT
+            p.id, p.name, p.description, p.sub_category_id, p.brand_id,
+            p.cover_url, p.min_price, b.name AS brand
+        FROM products p
+        LEFT JOIN brands b ON p.brand_id = b.id
+        WHERE p.total_quantity > 0
+    """):
+        seen += 1
+        if len(sample) < FEATURED_SIZE:
+            sample.append(row)
+        else:
+            j = random.randrange(seen)
+            if j < FEATURED_SIZE:
+                sample[j] = row
+    random.shuffle(sample)
+    _featured = sample
+    logging.info(f"Подборка для инлайн-поиска обновлена: {len(sample)} из {seen} товаров")
+
+
+async def _featured_loop():
+    while True:
+        # Флаг снимаем до пересборки: изменения, пришедшие во время неё, вызовут ещё одну
+        _featured_stale.clear()
+        try:
+            await refresh_featured()
+        except Exception:
+            logging.exception("Не удалось обновить подборку для инлайн-поиска")
+        try:
+            await asyncio.wait_for(_featured_stale.wait(), FEATURED_REFRESH)
+        except asyncio.TimeoutError:
+            continue
+        await asyncio.sleep(FEATURED_DEBOUNCE)
+
+
+def start_featured_refresh():
+    """Запускает фоновую пересборку подборки. Вызывается при старте бота после init_db()."""
+    global _featured_task
+    if _featured_task is None:
+        _featured_task = asyncio.create_task(_featured_loop())
+
+
+async def stop_featured_refresh():
+    """Останавливает фоновую пересборку. Вызывается перед close_db()."""
+    global _featured_task
+    if _featured_task is None:
+        return
+    _featured_task.cancel()
+    try:
+        await _featured_task
+    except asyncio.CancelledError:
+        pass
+    _featured_task = None
@@ -0,0 +1,39 @@
+from db import fetchone
+
+# Остатки и цены вариантов в памяти для проверок корзины (+1 в корзину, ➕ в корзине).
+# Вариант читается из БД при первом обращении и дальше отдаётся из памяти,
+# пока его не сбросит invalidate_stock(). Сброс делает catalog_cache.invalidate_listings(),
+# которую и так вызывает каждая запись, меняющая остатки или каталог
+# (правка варианта, подтверждение, отклонение и отмена заказа).
+#
+# quantity здесь — свободный остаток: на складе минус зарезервированное за заказами
+# (см. reservations.py). Сброс после смены резервов делают те же invalidate_listings().
+#
+# Снимок может на мгновение отставать от склада, поэтому окончательная проверка
+# остатков — при оформлении заказа, по БД (см. client_handlers.ask_phone).
+
+# variant_id -> dict(quantity, price) или None, если варианта нет
+_stock = {}
+# Растёт при каждом сбросе: прочитанное до сброса в снимок не кладём
+_generation = 0
+
+
+async def get_stock(variant_id):
+    """dict со свободным остатком (quantity) и ценой варианта или None, если варианта нет."""
+    variant_id = int(variant_id)
+    if variant_id in _stock:
+        return _stock[variant_id]
+
+    generation = _generation
+    row = await fetchone("SELECT quantity - reserved AS quantity, price FROM product_variants WHERE id = ?", (variant_id,))
+    entry = {'quantity': row['quantity'], 'price': row['price']} if row else None
+    if generation == _generation:
+        _stock[variant_id] = entry
+    return entry
+
+
+def invalidate_stock():
+    """Сбрасывает снимок остатков целиком."""
+    global _generation
+    _generation += 1
+    _stock.clear()
@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import create_db
+import db
+from reservations import confirm_order, reserve_stock, OutOfStock
+
+# Нагрузочная проверка подтверждения заказов: много одновременных подтверждений
+# из нескольких процессов (как несколько копий бота или админов) против локальной базы.
+# Заказов заведомо больше, чем товара на складе; часть из них с резервом, часть без
+# (резерв истёк), и каждый заказ подтверждается дважды.
+#
+# После прогона проверяются инварианты:
+#   - ни один остаток не ушёл в минус, и резерв не больше остатка (свободный остаток >= 0);
+#   - каждый заказ с резервом подтверждён: резерв превращается в списание;
+#   - склад уменьшился ровно на состав списанных заказов (ни двойных, ни потерянных списаний);
+#   - подтверждён = списан; неподтверждённые заказы и их резервы не тронуты;
+#   - product_variants.reserved равен сумме строк reservations;
+#   - свёртка продаж совпадает со списанными заказами.
+#
+#   python stress_confirmations.py                       # временная база, по умолчанию
+#   python stress_confirmations.py --orders 500 --workers 8 --db /tmp/stress.db
+#
+# База по указанному пути ПЕРЕСОЗДАЁТСЯ (create_db.py) — не запускайте на рабочей.
+
+
+def _use_db(path):
+    # Модули берут путь из configs при импорте — подменяем его у тех, кто открывает базу
+    db.DB_FILE = path
+    create_db.DB_FILE = path
+
+
+async def _seed(variants, stock, orders, reserved_share):
+    """Товар с variants вариантами по stock штук и orders заказов по 1–3 позиции.
+
+    Возвращает (id всех заказов, id заказов с резервом).
+    """
+    async with db.transaction() as tx:
+        await tx.execute("INSERT INTO categories (name) VALUES ('Стресс')")
+        await tx.execute("INSERT INTO sub_categories (name, category_id) VALUES ('Стресс', 1)")
+        await tx.execute("INSERT INTO brands (name) VALUES ('Стресс')")
+        await tx.execute("INSERT INTO colors (name) VALUES ('Чёрный')")
+        product_id = await tx.execute(
+            "INSERT INTO products (name, description, category_id, sub_category_id, brand_id, sku) "
+            "VALUES ('Стресс-товар', '', 1, 1, 1, 'STRESS')"
+        )
+        variant_ids = []
+        for _ in range(variants):
+            variant_ids.append(await tx.execute(
+                "INSERT INTO product_variants (product_id, color_id, price, quantity) VALUES (?, 1, 1000, ?)",
+                (product_id, stock),
+            ))
+
+    order_ids, held = [], []
+    for n in range(orders):
+        items = {vid: random.randint(1, 3) for vid in random.sample(variant_ids, random.randint(1, min(3, variants)))}
+        async with db.transaction() as tx:
+            order_id = await tx.execute(
+                "INSERT INTO orders (user_id, user_name, user_address, user_phone, cart, total_price, status) "
+                "VALUES (?, 'Стресс', '-', '-', '{}', ?, 'pending_verification')",
+                (n, 1000 * sum(items.values())),
+            )
+            await tx.executemany(
+                "INSERT INTO order_items (order_id, variant_id, name, brand, price, quantity) VALUES (?, ?, 'Стресс-товар', 'Стресс', 1000, ?)",
+                [(order_id, vid, qty) for vid, qty in items.items()],
+            )
+        # Резерв — пока хватает свободного остатка; остальные заказы "без резерва"
+        if random.random() < reserved_share:
+            try:
+                async with db.transaction() as tx:
+                    await reserve_stock(tx, order_id, items)
+                held.append(order_id)
+            except OutOfStock:
+                pass
+        order_ids.append(order_id)
+    return order_ids, held
+
+
+def _worker(path, order_ids):
+    """Процесс-подтверждающий: свой пул соединений, все заказы — одновременно."""
+    _use_db(path)
+
+    async def run():
+        await db.init_db()
+        try:
+            async def confirm(order_id):
+                return order_id, await confirm_order(order_id, await db.fetch_order_items(order_id))
+            return await asyncio.gather(*(confirm(order_id) for order_id in order_ids))
+        finally:
+            await db.close_db()
+
+    return [(order_id, _outcome(short)) for order_id, short in asyncio.run(run())]
+
+
+def _outcome(short):
+    # Итог confirm_order: refused — заказ уже не ждёт подтверждения, short — не хватило остатка
+    if short is None:
+        return "refused"
+    return "short" if short else "confirmed"
+
+
+def check_invariants(path, stock, held):
+    """Список нарушенных инвариантов (пустой — всё в порядке)."""
+    conn = sqlite3.connect(path)
+    problems = []
+    try:
+        negative = conn.execute("SELECT id, quantity FROM product_variants WHERE quantity < 0").fetchall()
+        if negative:
+            problems.append(f"отрицательные остатки: {negative}")
+
+        overheld = conn.execute("SELECT id, quantity, reserved FROM product_variants WHERE reserved > quantity").fetchall()
+        if overheld:
+            problems.append(f"резерв больше остатка (id, quantity, reserved): {overheld}")
+
+        unfilled = conn.execute(
+            "SELECT id, status FROM orders WHERE id IN (SELECT value FROM json_each(?)) AND status <> 'confirmed'",
+            (json.dumps(held),),
+        ).fetchall()
+        if unfilled:
+            problems.append(f"заказы с резервом не подтверждены: {unfilled}")
+
+        drift = conn.execute("""
+            SELECT pv.id, ? - pv.quantity AS deducted, COALESCE(d.qty, 0) AS ordered
+            FROM product_variants pv
+            LEFT JOIN (
+                SELECT oi.variant_id, SUM(oi.quantity) AS qty
+                FROM order_items oi JOIN orders o ON o.id = oi.order_id
+                WHERE o.deducted_from_stock = 1
+                GROUP BY oi.variant_id
+            ) d ON d.variant_id = pv.id
+            WHERE ? - pv.quantity <> COALESCE(d.qty, 0)
+        """, (stock, stock)).fetchall()
+        if drift:
+            problems.append(f"списано не столько, сколько в списанных заказах (id, списано, заказано): {drift}")
+
+        mismatched = conn.execute("""
+            SELECT id, status, deducted_from_stock FROM orders
+            WHERE (status = 'confirmed') <> (deducted_from_stock = 1)
+               OR status NOT IN ('confirmed', 'pending_verification')
+        """).fetchall()
+        if mismatched:
+            problems.append(f"статус не совпадает со списанием: {mismatched}")
+
+        held_confirmed = conn.execute("""
+            SELECT DISTINCT r.order_id FROM reservations r JOIN orders o ON o.id = r.order_id
+            WHERE o.status = 'confirmed'
+        """).fetchall()
+        if held_confirmed:
+            problems.append(f"у подтверждённых заказов остался резерв: {held_confirmed}")
+
+        reserved = conn.execute("""
+            SELECT pv.id, pv.reserved, COALESCE(SUM(r.qty), 0) AS held
+            FROM product_variants pv LEFT JOIN reservations r ON r.variant_id = pv.id
+            GROUP BY pv.id HAVING pv.reserved <> held
+        """).fetchall()
+        if reserved:
+            problems.append(f"reserved не равен сумме резервов (id, reserved, в reservations): {reserved}")
+
+        sales = conn.execute("""
+            SELECT (SELECT COALESCE(SUM(orders), 0) FROM sales_daily_totals),
+                   (SELECT COUNT(*) FROM orders WHERE deducted_from_stock = 1)
+        """).fetchone()
+        if sales[0] != sales[1]:
+            problems.append(f"свёртка продаж: {sales[0]} заказов, списано {sales[1]}")
+    finally:
+        conn.close()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Одновременные подтверждения заказов и проверка инвариантов склада")
+    parser.add_argument("--db", help="путь к тестовой базе (будет пересоздана); по умолчанию — временная")
+    parser.add_argument("--variants", type=int, default=5)
+    parser.add_argument("--stock", type=int, default=40, help="остаток каждого варианта")
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4, help="сколько процессов подтверждают одновременно")
+    parser.add_argument("--reserved-share", type=float, default=0.5, help="доля заказов с резервом")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="stress_"), "shop.db")
+    _use_db(path)
+    asyncio.run(create_db.main())
+
+    async def seed():
+        await db.init_db()
+        try:
+            return await _seed(args.variants, args.stock, args.orders, args.reserved_share)
+        finally:
+            await db.close_db()
+
+    order_ids, held = asyncio.run(seed())
+    print(f"\nЗаказов: {len(order_ids)} (с резервом {len(held)}), вариантов: {args.variants} по {args.stock} шт., процессов: {args.workers}")
+
+    # Каждый заказ попадает в два разных процесса: двойное подтверждение не должно списать дважды
+    slices = [[] for _ in range(args.workers)]
+    for n, order_id in enumerate(order_ids):
+        slices[n % args.workers].append(order_id)
+        slices[(n + 1) % args.workers].append(order_id)
+    for part in slices:
+        random.shuffle(part)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = [row for part in pool.map(_worker, [path] * args.workers, slices) for row in part]
+
+    counts = {outcome: sum(1 for _, result in results if result == outcome) for outcome in ("confirmed", "short", "refused")}
+    print(
+        f"Подтверждений: {len(results)}, успешных: {counts['confirmed']}, "
+        f"отказов из-за остатка: {counts['short']}, уже обработанных: {counts['refused']}"
+    )
+
+    problems = check_invariants(path, args.stock, held)
+    if problems:
+        print("❌ Нарушены инварианты:")
+        for problem in problems:
+            print(f"  • {problem}")
+        return 1
+    print(f"✅ Инварианты соблюдены ({path}).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())